@@ -0,0 +1,523 @@
+"""Optional GameEngine backend that stores entities in NumPy arrays and
+advances them with batched array operations."""
+
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from fixedpoint import ONE, to_units
+from game import GameEngine
+from game_objects import ARENA_UNITS, KNOCKBACK_DECAY, SQRT_2, EntityKind, deserialize_entity
+from globalvars import *
+from history import Snapshot
+
+PLAYER = EntityKind.PLAYER.value
+PROJECTILE = EntityKind.PROJECTILE.value
+PICKUP = EntityKind.PICKUP.value
+KIND_NAMES = {PLAYER: "player", PROJECTILE: "projectile", PICKUP: "pickup"}
+
+# Type of the arrays holding positions, velocities and directions, in units.
+UNIT_DTYPE = 'i8' if FIXED_POINT else 'f8'
+# Sizes and speeds of each kind of entity, in units.
+KIND_SIZES = {PLAYER: to_units(PLAYER_SIZE), PROJECTILE: to_units(PROJECTILE_SIZE), PICKUP: to_units(PROJECTILE_SIZE)}
+KIND_SPEEDS = {PLAYER: to_units(PLAYER_SPEED), PROJECTILE: to_units(PROJECTILE_SPEED), PICKUP: 0}
+# How many slots to allocate when the engine is reset.
+INITIAL_CAPACITY = 64
+# Layout of game_objects.CHECKSUM_RECORD, as a NumPy record type.
+CHECKSUM_FIELDS = [('eid', '>i8'), ('kind', 'i1'), ('position', '>f8', 2), ('velocity', '>f8', 2),
+    ('direction', '>f8', 2), ('knockback', '>i8'), ('score', '>i8')]
+# Arrays holding a field of every entity, indexed by slot.
+ARRAY_FIELDS = ('alive', 'kind', 'eid', 'size', 'speed', 'knockback', 'owner', 'score', 'position', 'velocity', 'direction')
+
+# Cell keys used to find nearby projectiles: a cell's row is added to its
+# column times CELL_STRIDE, both shifted by CELL_OFFSET so they're positive.
+CELL_OFFSET = 1 << 20
+CELL_STRIDE = 1 << 21
+# Offsets of the cells checked from each cell, including itself. Only half of
+# the neighbours are listed so that every pair of cells is visited once.
+CELL_NEIGHBOURS = ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+
+def array_mul(a, b):
+    """Multiplies arrays of values in units, as fixedpoint.mul does."""
+    if FIXED_POINT:
+        product = a * b
+        return np.sign(product) * (np.abs(product) // ONE)
+    return a * b
+
+def array_div(a, b):
+    """Divides arrays of values in units, as fixedpoint.div does."""
+    if FIXED_POINT:
+        return np.sign(a) * np.sign(b) * (np.abs(a * ONE) // np.abs(b))
+    return a / b
+
+def array_whole(a):
+    """Truncates an array of values in units to whole pixels, as
+    fixedpoint.whole does."""
+    if FIXED_POINT:
+        return np.sign(a) * (np.abs(a) // ONE * ONE)
+    return np.trunc(a)
+
+def overlapping(a_positions, a_sizes, b_positions, b_sizes):
+    """Returns a boolean matrix telling which entities of group A overlap
+    which entities of group B."""
+    dx = a_positions[:, 0][:, None] - b_positions[:, 0][None, :]
+    dy = a_positions[:, 1][:, None] - b_positions[:, 1][None, :]
+    reach = a_sizes[:, None] + b_sizes[None, :]
+    return dx*dx + dy*dy < reach*reach
+
+def close_pairs(positions, sizes):
+    """Returns two arrays of indices (i, j), with i < j, of every pair of
+    entities in the group that overlap. Entities are bucketed into a grid so
+    only entities in the same or neighbouring cells are compared."""
+    count = len(positions)
+    if count < 2:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    cells = np.floor(positions / (2*sizes.max())).astype(np.int64) + CELL_OFFSET
+    keys = cells[:, 0]*CELL_STRIDE + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    firsts = []
+    seconds = []
+    for d_column, d_row in CELL_NEIGHBOURS:
+        targets = keys + d_column*CELL_STRIDE + d_row
+        lo = np.searchsorted(sorted_keys, targets, 'left')
+        counts = np.searchsorted(sorted_keys, targets, 'right') - lo
+        total = counts.sum()
+        if not total:
+            continue
+        # pair each entity with every entity in the target cell
+        first = np.repeat(np.arange(count), counts)
+        starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        second = order[starts + np.arange(total)]
+        if d_column == 0 and d_row == 0:
+            keep = first < second
+            first = first[keep]
+            second = second[keep]
+        firsts.append(first)
+        seconds.append(second)
+    if not firsts:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    delta = positions[first] - positions[second]
+    reach = sizes[first] + sizes[second]
+    close = delta[:, 0]*delta[:, 0] + delta[:, 1]*delta[:, 1] < reach*reach
+    return (np.minimum(first[close], second[close]), np.maximum(first[close], second[close]))
+
+
+class EntityView:
+    """An entity stored in an ArrayGameEngine. Has the same attributes as the
+    GameEntity classes, read from and written to the engine's arrays."""
+
+    __slots__ = ('engine', 'slot')
+
+    def __init__(self, engine, slot):
+        self.engine = engine
+        self.slot = slot
+
+    def __repr__(self):
+        return f'<{self.kind.name} {self.eid} at {self.position}>'
+
+    @property
+    def kind(self):
+        return EntityKind(int(self.engine.kind[self.slot]))
+
+    @property
+    def eid(self):
+        return int(self.engine.eid[self.slot])
+
+    @property
+    def size(self):
+        return int(self.engine.size[self.slot])
+
+    @property
+    def speed(self):
+        return int(self.engine.speed[self.slot])
+
+    @property
+    def position(self):
+        x,y = self.engine.position[self.slot].tolist()
+        return (x,y)
+
+    @position.setter
+    def position(self, position):
+        self.engine.position[self.slot] = position
+
+    @property
+    def velocity(self):
+        x,y = self.engine.velocity[self.slot].tolist()
+        return (x,y)
+
+    @velocity.setter
+    def velocity(self, velocity):
+        self.engine.velocity[self.slot] = velocity
+
+    @property
+    def direction(self):
+        x,y = self.engine.direction[self.slot].tolist()
+        return (x,y)
+
+    @direction.setter
+    def direction(self, direction):
+        self.engine.direction[self.slot] = direction
+
+    @property
+    def knockback(self):
+        return int(self.engine.knockback[self.slot])
+
+    @knockback.setter
+    def knockback(self, knockback):
+        self.engine.knockback[self.slot] = knockback
+
+    @property
+    def score(self):
+        return int(self.engine.score[self.slot])
+
+    @score.setter
+    def score(self, score):
+        self.engine.score[self.slot] = score
+
+    @property
+    def uid(self):
+        return self.engine.uids[self.engine.owner[self.slot]]
+
+    @uid.setter
+    def uid(self, uid):
+        self.engine.owner[self.slot] = self.engine.uid_code(uid)
+
+    # projectiles are owned by the player with the matching uid
+    owner_uid = uid
+
+    @property
+    def value(self):
+        return POINTS_PER_PICKUP
+
+    def serialize(self):
+        return self.engine.serialize_slot(self.slot)
+
+
+class ArraySnapshot(Snapshot):
+    """Snapshot of an ArrayGameEngine. Its entities are EntityViews, and the
+    slots below the next entity ID are copied into arrays kept with the
+    snapshot, which are reused when the snapshot is."""
+
+    __slots__ = ('arrays',)
+
+    def __init__(self):
+        super().__init__()
+        self.arrays = {}
+
+class ArrayGameEngine(GameEngine):
+    """GameEngine that keeps entity kind, position, velocity, size, knockback
+    and owner in NumPy arrays, using entity IDs as indices, and moves every
+    entity in a single batch each tick. Produces the same states as
+    GameEngine. Since entity IDs are handed out lowest first, the arrays only
+    need to be as big as the most entities there have been at once.
+
+    The entities dict holds an EntityView for each entity, so code using the
+    GameEngine API can keep reading and writing entity attributes."""
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('the numpy engine backend requires NumPy')
+        super().__init__()
+
+    def reset_game(self):
+        super().reset_game()
+        # user IDs are stored in the owner array as indices into this list
+        self.uids = []
+        self.uid_codes = {}
+        self.allocate(INITIAL_CAPACITY)
+
+    def allocate(self, capacity):
+        """Replaces the arrays with empty ones with the given capacity,
+        keeping the contents of slots below the next entity ID."""
+        old = getattr(self, 'kind', None)
+        count = 0 if old is None else min(self.next_entity_id, len(old), capacity)
+        arrays = {
+            'alive': np.zeros(capacity, dtype=bool),
+            'kind': np.zeros(capacity, dtype=np.int8),
+            'eid': np.zeros(capacity, dtype=np.int64),
+            'size': np.zeros(capacity, dtype=np.int64),
+            'speed': np.zeros(capacity, dtype=np.int64),
+            'knockback': np.full(capacity, -1, dtype=np.int64),
+            'owner': np.full(capacity, -1, dtype=np.int64),
+            'score': np.zeros(capacity, dtype=np.int64),
+            'position': np.zeros((capacity, 2), dtype=UNIT_DTYPE),
+            'velocity': np.zeros((capacity, 2), dtype=UNIT_DTYPE),
+            'direction': np.zeros((capacity, 2), dtype=UNIT_DTYPE),
+        }
+        for name, array in arrays.items():
+            if old is not None:
+                array[:count] = getattr(self, name)[:count]
+            setattr(self, name, array)
+
+    def uid_code(self, uid):
+        """Returns the index representing the user ID in the owner array."""
+        if uid not in self.uid_codes:
+            self.uid_codes[uid] = len(self.uids)
+            self.uids.append(uid)
+        return self.uid_codes[uid]
+
+    def store(self, kind, eid, position, velocity, owner=-1, knockback=-1, score=0, direction=(0,0), insert=True):
+        """Stores an entity in the slot given by its entity ID, and returns
+        its EntityView, which is put in the entities dict unless insert is
+        False."""
+        slot = eid
+        if slot >= len(self.kind):
+            self.allocate(max(2*len(self.kind), slot+1))
+        self.alive[slot] = True
+        self.kind[slot] = kind
+        self.eid[slot] = eid
+        self.size[slot] = KIND_SIZES[kind]
+        self.speed[slot] = KIND_SPEEDS[kind]
+        self.position[slot] = position
+        self.velocity[slot] = velocity
+        self.owner[slot] = owner
+        self.knockback[slot] = knockback
+        self.score[slot] = score
+        self.direction[slot] = direction
+        view = EntityView(self, slot)
+        if insert:
+            self.insert_entity(view)
+        return view
+
+    def add_entity(self, entity):
+        """Copies an entity into the arrays, giving it the lowest free entity
+        ID if it doesn't have one yet. Returns the EntityView standing in for it."""
+        eid = self.next_eid() if entity.eid is None else entity.eid
+        if entity.kind == EntityKind.PLAYER:
+            return self.store(PLAYER, eid, entity.position, entity.velocity,
+                owner=self.uid_code(entity.uid), knockback=entity.knockback,
+                score=entity.score, direction=entity.direction)
+        elif entity.kind == EntityKind.PROJECTILE:
+            return self.store(PROJECTILE, eid, entity.position, entity.velocity,
+                owner=self.uid_code(entity.owner_uid))
+        else:
+            return self.store(PICKUP, eid, entity.position, entity.velocity)
+
+    def remove_entity(self, entity):
+        # views are rebuilt with every new entity, so there's nothing to pool
+        self.alive[entity.eid] = False
+        self.release_eid(entity.eid)
+        return self.entities.pop(entity.eid)
+
+    def load_state(self, game_state):
+        """Load the given game state to the current tick.  If one is not
+        given, load the most recent game state we've been given."""
+        if game_state is not None:
+            self.current_tick = game_state['tick']
+            self.pickups_generated = game_state['generated']
+            self.live_pickups = game_state['live']
+            self.alive[:self.next_entity_id] = False
+            self.next_entity_id = game_state['next_eid']
+            self.entities = {}
+            self.entity_ids = []
+            for e in sorted(game_state['entities'], key=lambda e: e['eid']):
+                self.add_entity(deserialize_entity(e))
+            self.reclaim_free_ids()
+            self.register_state()
+            self.record_checksum()
+
+    def snapshot(self, snapshot=None):
+        if snapshot is None:
+            snapshot = ArraySnapshot()
+        snapshot.tick = self.current_tick
+        snapshot.generated = self.pickups_generated
+        snapshot.live = self.live_pickups
+        snapshot.next_eid = count = self.next_entity_id
+        for name in ARRAY_FIELDS:
+            array = getattr(self, name)
+            saved = snapshot.arrays.get(name)
+            if saved is None or len(saved) < count:
+                saved = snapshot.arrays[name] = np.empty_like(array)
+            np.copyto(saved[:count], array[:count])
+        snapshot.entities[:] = self.entities.values()
+        return snapshot
+
+    def restore(self, snapshot):
+        self.current_tick = snapshot.tick
+        self.pickups_generated = snapshot.generated
+        self.live_pickups = snapshot.live
+        count = snapshot.next_eid
+        if len(self.kind) < count:
+            self.allocate(len(snapshot.arrays['kind']))
+        self.alive[count:self.next_entity_id] = False
+        self.next_entity_id = count
+        for name in ARRAY_FIELDS:
+            np.copyto(getattr(self, name)[:count], snapshot.arrays[name][:count])
+        self.entities.clear()
+        for view in snapshot.entities:
+            self.entities[view.slot] = view
+        self.reclaim_free_ids()
+
+    def entities_checksum(self):
+        """Returns the sum of the checksums of every entity, packing the
+        records GameEntity.checksum packs one at a time in a single batch."""
+        live = np.flatnonzero(self.alive[:self.next_entity_id])
+        records = np.empty(len(live), dtype=np.dtype(CHECKSUM_FIELDS))
+        for name, *_ in CHECKSUM_FIELDS:
+            records[name] = getattr(self, name)[live]
+        data = records.tobytes()
+        size = records.itemsize
+        return sum(zlib.crc32(data[i:i+size]) for i in range(0, len(data), size))
+
+    def serialize_slot(self, slot):
+        """Returns a dict with the same properties GameEntity.serialize gives."""
+        kind = int(self.kind[slot])
+        data = {
+            "eid": int(self.eid[slot]),
+            "position": self.position[slot].tolist(),
+            "velocity": self.velocity[slot].tolist(),
+            "kind": KIND_NAMES[kind],
+        }
+        if kind == PLAYER:
+            data['knockback'] = int(self.knockback[slot])
+            data['uid'] = self.uids[self.owner[slot]]
+            data['score'] = int(self.score[slot])
+            data['direction'] = self.direction[slot].tolist()
+        elif kind == PROJECTILE:
+            data['owner_uid'] = self.uids[self.owner[slot]]
+        return data
+
+    def serialize_current_state(self):
+        """Returns a dict representing the current state of the game."""
+        return {
+            "entities": [self.serialize_slot(slot) for slot in self.entities],
+            "tick": self.current_tick,
+            "generated": self.pickups_generated,
+            "live": self.live_pickups,
+            "next_eid": self.next_entity_id
+        }
+
+    def player_inputs(self, players):
+        """Returns an array of this tick's packed input for each player slot
+        given, received or predicted, with -1 for players we have neither
+        for."""
+        inputs = self.inputs
+        tick = self.current_tick
+        uids = self.uids
+        user_inputs = [inputs.input_for(tick, uids[code]) for code in self.owner[players].tolist()]
+        return np.array([-1 if i is None else i for i in user_inputs], dtype=np.int64)
+
+    def advance_tick(self):
+        """Advances the game by one tick, updating the positions and states
+        of all game entities.
+
+        Entities are processed in batches, with the results GameEngine gets by
+        processing them one at a time in entity ID order: a player hit by a
+        projectile with a lower ID is knocked back before its own update, and
+        one hit by a projectile with a higher ID after it has moved."""
+        # save the current state every STATE_SAVE_RATE frames
+        if self.current_tick % STATE_SAVE_RATE == 0:
+            self.register_state()
+
+        n = self.next_entity_id
+        alive = self.alive[:n]
+        kind = self.kind[:n]
+        players = np.flatnonzero(alive & (kind == PLAYER))
+        projectiles = np.flatnonzero(alive & (kind == PROJECTILE))
+        pickups = np.flatnonzero(alive & (kind == PICKUP))
+        # collisions use positions from the start of the tick
+        start = self.position[:n].copy()
+        player_positions = start[players]
+        player_sizes = self.size[players]
+
+        # projectiles hitting players other than their owner
+        hits = overlapping(start[projectiles], self.size[projectiles], player_positions, player_sizes)
+        hits &= self.owner[projectiles][:, None] != self.owner[players][None, :]
+        # latest projectile (in slot order) hitting each player before and
+        # after the player's own slot, as an index into projectiles
+        ranks = np.arange(len(projectiles))[:, None]
+        before = hits & (projectiles[:, None] < players[None, :])
+        after = hits & (projectiles[:, None] > players[None, :])
+        last_before = np.where(before, ranks, -1).max(axis=0, initial=-1)
+        last_after = np.where(after, ranks, -1).max(axis=0, initial=-1)
+
+        # knockback from projectiles processed before each player
+        self.take_hits(players, projectiles, last_before)
+
+        # player movement from input
+        kb = self.knockback[players]
+        inputs = self.player_inputs(players)
+        velocity = self.velocity[players]
+        speed = self.speed[players][:, None]
+        decaying = kb > 0
+        velocity[decaying] = array_mul(KNOCKBACK_DECAY, array_div(velocity[decaying], speed[decaying]))
+        velocity[kb == 0] = 0
+        steering = (kb < 0) & (inputs >= 0)
+        player_speed = KIND_SPEEDS[PLAYER]
+        vel_x = np.where(inputs & INPUT_RIGHT, player_speed, 0) - np.where(inputs & INPUT_LEFT, player_speed, 0)
+        vel_y = np.where(inputs & INPUT_DOWN, player_speed, 0) - np.where(inputs & INPUT_UP, player_speed, 0)
+        diagonal = (vel_x != 0) & (vel_y != 0)
+        vel_x = np.where(diagonal, array_whole(array_div(vel_x, SQRT_2)), vel_x)
+        vel_y = np.where(diagonal, array_whole(array_div(vel_y, SQRT_2)), vel_y)
+        steered = np.stack((vel_x, vel_y), axis=1).astype(UNIT_DTYPE)
+        velocity[steering] = steered[steering]
+        turning = steering & ((vel_x != 0) | (vel_y != 0))
+        direction = self.direction[players]
+        direction[turning] = array_div(steered[turning], speed[turning])
+        self.velocity[players] = velocity
+        self.direction[players] = direction
+        self.knockback[players] = np.where(decaying, kb-1, np.where(kb == 0, -1, kb))
+
+        # players firing projectiles, from where they started the tick
+        firing = (inputs >= 0) & ((inputs & INPUT_FIRE) != 0) & (direction != 0).any(axis=1)
+        shots = [(self.owner[players[i]], player_positions[i], direction[i]*PROJECTILE_SPEED)
+                 for i in np.flatnonzero(firing).tolist()]
+
+        # projectiles hitting each other or leaving the arena
+        to_delete = projectiles[hits.any(axis=1)]
+        first, second = close_pairs(start[projectiles], self.size[projectiles])
+        sizes = self.size[projectiles][:, None]
+        outside = ((start[projectiles] - sizes < 0) | (start[projectiles] + sizes > ARENA_UNITS)).any(axis=1)
+        to_delete = np.concatenate((to_delete, projectiles[first], projectiles[second], projectiles[outside]))
+
+        # pickups collected by every player touching them
+        collected = overlapping(start[pickups], self.size[pickups], player_positions, player_sizes)
+        self.score[players] += POINTS_PER_PICKUP*collected.sum(axis=0)
+        self.live_pickups -= int(collected.sum())
+        to_delete = np.concatenate((to_delete, pickups[collected.any(axis=1)]))
+
+        # update positions, keeping players inside the arena
+        self.position[:n][alive] += self.velocity[:n][alive]
+        position = self.position[players]
+        sizes = player_sizes[:, None]
+        position = np.where(position - sizes < 0, sizes, np.where(position + sizes > ARENA_UNITS, ARENA_UNITS - sizes, position))
+        self.position[players] = position
+
+        # knockback from projectiles processed after each player
+        self.take_hits(players, projectiles, last_after)
+
+        # spawn pickup if we're supposed to
+        if self.live_pickups < MAX_PICKUPS and self.current_tick % PICKUP_SPAWN_RATE == 0:
+            self.spawn_pickup()
+
+        # cull entities
+        for eid in np.unique(to_delete).tolist():
+            self.remove_entity(self.entities[eid])
+
+        # add entities
+        self.insert_entities([self.store(PROJECTILE, self.next_eid(), position, velocity, owner=owner, insert=False)
+                              for owner, position, velocity in shots])
+
+        # advance tick
+        self.current_tick += 1
+        self.record_checksum()
+
+    def take_hits(self, players, projectiles, hitting):
+        """Knocks back each player hit by a projectile, given the index into
+        projectiles of the one that hit it, or -1."""
+        hit = hitting >= 0
+        if not hit.any():
+            return
+        hit_players = players[hit]
+        hit_by = projectiles[hitting[hit]]
+        self.knockback[hit_players] = KNOCKBACK_TIME
+        self.velocity[hit_players] = array_mul(to_units(KNOCKBACK_SPEED), array_div(self.velocity[hit_by], self.speed[hit_by][:, None]))
@@ -0,0 +1,139 @@
+"""GameServer that runs on an asyncio event loop, waiting for connections,
+messages and ticks rather than polling its sockets in a loop."""
+
+import asyncio
+import time
+import uuid
+
+import game
+import helpers
+import ticker
+from globalvars import *
+
+class AsyncGameServer(game.GameServer):
+    """GameServer where every connection is an asyncio stream read by its own
+    task, and each match is played by a task that sleeps until each of its
+    ticks is due. Users keep joining while matches are played, and a new
+    match starts as soon as enough of them are waiting. Between messages and ticks
+    the server is idle, and inputs are relayed as soon as they've been
+    handled rather than on the next pass of a loop."""
+
+    def __init__(self, port=SERVER_PORT):
+        super().__init__(port=port)
+        # set once enough users are waiting in the lobby to start a match
+        self.match_ready = asyncio.Event()
+        # whether relaying the inputs handled so far has been scheduled
+        self.relay_scheduled = False
+        # tasks playing each match, kept so they aren't garbage collected
+        self.match_tasks = set()
+
+    async def serve(self):
+        """Accepts connections, and starts a match each time enough users
+        are waiting in the lobby."""
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        addr,port = self.socket.getsockname()
+        print(f"Listening for users on {addr}:{port}...")
+        async with server:
+            while True:
+                LOGGER.debug('waiting for match...')
+                await self.match_ready.wait()
+                self.match_ready.clear()
+
+                while self.lobby.ready():
+                    LOGGER.debug('starting match...')
+                    if not self.begin_match():
+                        LOGGER.debug('failed to start match.')
+                        break
+
+    def begin_match(self):
+        """Announces a match for the users who have waited longest in the
+        lobby, and starts a task playing it. Returns False if it can't
+        begin."""
+        match = self.announce_match()
+        if match is None:
+            return False
+        task = asyncio.create_task(self.run_match(match))
+        self.match_tasks.add(task)
+        task.add_done_callback(self.match_tasks.discard)
+        return True
+
+    async def run_match(self, match):
+        """Waits for an announced match's countdown to finish, plays it, and
+        ends it."""
+        await asyncio.sleep(max(0, match.start_time - time.time()))
+        match.in_game = True
+        await self.play_match(match)
+        self.end_match(match)
+
+    async def play_match(self, match):
+        """Advances the match every 1/FRAMERATE seconds until it's over. Its
+        ticks are scheduled with a TickScheduler on the event loop's clock,
+        so time spent handling messages and other matches doesn't make them
+        drift, and ticks missed while the loop was busy are caught up."""
+        ticks = ticker.TickScheduler(clock=asyncio.get_running_loop().time)
+        while not match.finished():
+            await asyncio.sleep(ticks.timeout())
+            for _ in range(ticks.due()):
+                if match.finished():
+                    break
+                match.advance()
+                # resync any clients whose state has diverged from ours
+                match.verify_clients()
+        ticks.log_stats(f'match {match.match_id} ticks')
+
+    async def handle_connection(self, reader, writer):
+        """Reads and handles messages from a user until they disconnect."""
+        user_id = str(uuid.uuid4())
+        self.user_sockets[user_id] = writer
+        LOGGER.debug('we have %d users in %d matches', len(self.user_sockets), len(self.matches))
+        try:
+            while True:
+                message = await helpers.read_message(reader)
+                if message is None:
+                    break
+                self.dispatch(user_id, message)
+        except (OSError, helpers.ProtocolError) as e:
+            LOGGER.debug('err reading from user %s: %s', user_id, e)
+        self.disconnect_user(user_id)
+
+    def dispatch(self, user_id, message):
+        """Handles a message from a user: JOIN_MATCH queues them up in the
+        lobby, and anything else is handled in their match once it has been
+        announced."""
+        if message['method'] == "JOIN_MATCH":
+            self.join_match(user_id)
+            self.check_match_ready()
+        elif self.route_message(user_id, message) is not None and not self.relay_scheduled:
+            # relay every input handled in this pass of the event loop at once
+            self.relay_scheduled = True
+            asyncio.get_running_loop().call_soon(self.relay_scheduled_inputs)
+
+    def check_match_ready(self):
+        """Wakes serve() if enough users are waiting in the lobby."""
+        if self.lobby.ready():
+            self.match_ready.set()
+
+    def relay_scheduled_inputs(self):
+        """Relays the inputs handled since relaying was scheduled."""
+        self.relay_scheduled = False
+        self.relay_inputs()
+
+    def send_to(self, user_id, *parts):
+        """Queues a packet, or the buffers making one up, to be sent to a
+        user. Users who leave more than SEND_QUEUE_LIMIT bytes waiting are
+        disconnected as too slow."""
+        writer = self.user_sockets[user_id]
+        if writer.is_closing():
+            return
+        writer.writelines(parts)
+        if writer.transport.get_write_buffer_size() > SEND_QUEUE_LIMIT:
+            LOGGER.debug('user %s has %d bytes waiting to be sent, disconnecting',
+                user_id, writer.transport.get_write_buffer_size())
+            self.disconnect_user(user_id)
+
+    def user_connected(self, user_id):
+        return (user_id in self.user_sockets) and (not self.user_sockets[user_id].is_closing())
+
+def run(port=SERVER_PORT):
+    """Runs an AsyncGameServer on the given port until interrupted."""
+    asyncio.run(AsyncGameServer(port=port).serve())
@@ -0,0 +1,580 @@
+"""Executable for running microbenchmarks of the game's hot paths."""
+
+import gc
+import json
+import logging
+import os
+import pickle
+import random
+import socket
+import sys
+import time
+import tracemalloc
+import uuid
+
+import game
+import helpers
+import simulate
+import ticker
+from fixedpoint import to_units
+from game_objects import EntityKind, EntityPool, Pickup, Player, Projectile
+from globalvars import (ARENA_SIZE, FRAMERATE, INPUT_DOWN, INPUT_FIRE, INPUT_LEFT, INPUT_RIGHT, INPUT_UP,
+    INPUT_WINDOW, LOGGER, PROJECTILE_SPEED, STATE_SAVE_RATE)
+
+# Framing used before the length-prefixed codec, kept here for comparison.
+LEGACY_PACKET_HEADER = b'\x57\x67'
+LEGACY_PACKET_TERM   = b'\xF1\x54'
+
+def legacy_marshal_message(message):
+    """Encodes a message the way helpers.marshal_message used to."""
+    return LEGACY_PACKET_HEADER+pickle.dumps(json.dumps(message).encode())+LEGACY_PACKET_TERM
+
+def legacy_decode_stream(buffer):
+    """Splits and decodes every packet in the buffer the way
+    helpers.recv_packet and helpers.unmarshal_message used to."""
+    messages = []
+    while LEGACY_PACKET_HEADER in buffer:
+        header_index = buffer.find(LEGACY_PACKET_HEADER)
+        if LEGACY_PACKET_TERM not in buffer[header_index:]:
+            break
+        term_index = buffer.find(LEGACY_PACKET_TERM, header_index)
+        packet = buffer[header_index:term_index+len(LEGACY_PACKET_TERM)]
+        buffer = buffer[term_index:]
+        message = packet[len(LEGACY_PACKET_HEADER):packet.rfind(LEGACY_PACKET_TERM)]
+        messages.append(json.loads(pickle.loads(message)))
+    return messages
+
+def decode_stream(buffer):
+    """Decodes every frame in the buffer with the current codec."""
+    messages = []
+    offset = 0
+    while True:
+        message, length = helpers.decode_frame(buffer, offset)
+        if message is None:
+            return messages
+        messages.append(message)
+        offset += length
+
+def sample_messages():
+    """Returns a few representative messages to push through the codecs,
+    each as the legacy codec sent it and as the framed codec sends it."""
+    legacy_input_message = {
+        "method": "USER_INPUT",
+        "inputs": [{
+            "user_id": "6f1c7d8e-7a8b-4c4d-9e0f-123456789abc",
+            "tick": 320,
+            "input_state": {"119": True, "97": False, "115": False, "100": False, "fired": True}
+        }]
+    }
+    input_message = {
+        "method": "USER_INPUT",
+        "inputs": [{
+            "user_id": "6f1c7d8e-7a8b-4c4d-9e0f-123456789abc",
+            "tick": 320,
+            "window": bytes([INPUT_UP|INPUT_FIRE] + [INPUT_UP]*(INPUT_WINDOW-1))
+        }]
+    }
+    state_message = {
+        "method": "GAME_STATE",
+        "state": {
+            "entities": [
+                {"kind": "projectile", "position": [40.0+i, 500.0], "velocity": [6.0, 8.0], "owner_uid": "6f1c7d8e"}
+                for i in range(20)
+            ],
+            "tick": 402,
+            "generated": 12,
+            "live": 5
+        }
+    }
+    return {"USER_INPUT": (legacy_input_message, input_message), "GAME_STATE": (state_message, state_message)}
+
+def time_rate(function, count):
+    """Calls the function and returns how many messages per second it handled,
+    given that a single call handles count messages."""
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+def bench_codec(count=20000, batch=32):
+    """Compares encode and decode throughput of the legacy pickle-wrapped
+    codec against the length-prefixed codec. Decoding is done on receive
+    buffers holding a batch of frames each, like a busy socket would."""
+    print(f"{'message':<12}{'codec':<10}{'encode msg/s':>16}{'decode msg/s':>16}{'bytes':>8}")
+    for name, (legacy_message, framed_message) in sample_messages().items():
+        for codec, message, encode, decode in (
+            ("legacy", legacy_message, legacy_marshal_message, legacy_decode_stream),
+            ("framed", framed_message, helpers.marshal_message, decode_stream),
+        ):
+            frame = encode(message)
+            encode_rate = time_rate(lambda: [encode(message) for _ in range(count)], count)
+            stream = frame * batch
+            decode_rate = time_rate(lambda: [decode(stream) for _ in range(count//batch)], count//batch*batch)
+            print(f"{name:<12}{codec:<10}{encode_rate:>16,.0f}{decode_rate:>16,.0f}{len(frame):>8}")
+
+def brute_force_collisions(engine):
+    """Checks every pair of entities for collisions, the way
+    GameEngine.check_collisions did before it used a grid."""
+    entities = [(eid, engine.entities[eid]) for eid in engine.entity_ids]
+    all_collisions = {}
+    for entity_id, entity in entities:
+        collisions = [other for (other_id, other) in entities
+                      if other_id != entity_id and engine.collided(entity, other)]
+        if collisions:
+            all_collisions[entity_id] = collisions
+    return all_collisions
+
+def populate_engine(count, seed=0, backend="python"):
+    """Returns a GameEngine holding the given number of entities at random
+    positions: a few players, and an even mix of projectiles and pickups."""
+    rng = random.Random(seed)
+    engine = game.create_engine(backend)
+    engine.generate_pickup_locations(seed)
+    position = lambda: (to_units(rng.uniform(0, ARENA_SIZE)), to_units(rng.uniform(0, ARENA_SIZE)))
+    for i in range(count):
+        if i < 4:
+            engine.add_entity(Player(uid=str(i), position=position()))
+        elif i % 2:
+            engine.add_entity(Projectile(str(i % 4), position(), (to_units(PROJECTILE_SPEED)*rng.choice((-1, 1)), 0)))
+        else:
+            engine.add_entity(Pickup(position()))
+    return engine
+
+def time_call(function, repeat):
+    """Returns the average number of seconds a call to the function takes."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def bench_collisions(counts=(10, 50, 100, 500, 1000, 2000, 5000), brute_force_limit=1000):
+    """Sweeps the number of entities, timing the grid broadphase against
+    checking every pair (up to brute_force_limit entities), and checking that
+    both find exactly the same collisions."""
+    LOGGER.setLevel('INFO')
+    print(f"{'entities':>8}{'grid ms':>12}{'pairs ms':>12}{'speedup':>10}{'tick ms':>12}  same")
+    for count in counts:
+        engine = populate_engine(count)
+        repeat = max(1, 2000 // count)
+        grid_time = time_call(engine.check_collisions, repeat)
+        if count <= brute_force_limit:
+            pair_time = time_call(lambda: brute_force_collisions(engine), max(1, repeat // 10))
+            same = brute_force_collisions(engine) == engine.check_collisions()
+            pairs = f"{pair_time*1000:>12.3f}{pair_time/grid_time:>9.1f}x"
+        else:
+            pairs = f"{'-':>12}{'-':>10}"
+            same = '-'
+        tick_time = time_call(engine.advance_tick, repeat)
+        print(f"{count:>8}{grid_time*1000:>12.3f}{pairs}{tick_time*1000:>12.3f}  {same}")
+
+def bench_backends(counts=(100, 1000, 5000), ticks=60, rollback=60):
+    """Compares ticks/sec of the python and numpy engine backends, and the
+    time to roll back and re-simulate a span of ticks."""
+    LOGGER.setLevel('INFO')
+    print(f"{'entities':>8}{'backend':>10}{'ticks/s':>12}{'rollback ms':>14}")
+    for count in counts:
+        for backend in ("python", "numpy"):
+            engine = populate_engine(count, backend=backend)
+            # stop everything so projectiles don't leave the arena mid-run
+            for entity in engine.entities.values():
+                entity.velocity = (0, 0)
+            start = time.perf_counter()
+            engine.advance_to(ticks)
+            rate = ticks / (time.perf_counter() - start)
+            rollback_time = time_call(lambda: engine.rollback(engine.current_tick - rollback), 1)
+            print(f"{count:>8}{backend:>10}{rate:>12,.1f}{rollback_time*1000:>14.1f}")
+
+def bench_rollback(lateness=(1, 5, 20, 60), count=200, start=250, save_rates=(100, 1)):
+    """Times rolling back to account for input arriving the given number of
+    ticks late, saving a state every save_rate ticks. The rollback is repeated
+    from each tick in a span, since with sparse saves the cost depends on
+    where the late tick falls relative to the last save."""
+    LOGGER.setLevel('INFO')
+    print(f"{'save rate':>10}" + ''.join(f"{f'{late} late ms':>14}" for late in lateness))
+    for save_rate in save_rates:
+        game.STATE_SAVE_RATE = save_rate
+        engine = populate_engine(count)
+        for entity in engine.entities.values():
+            entity.velocity = (0, 0)
+        engine.advance_to(start)
+        times = []
+        for late in lateness:
+            total = 0
+            for _ in range(20):
+                engine.advance_tick()
+                total += time_call(lambda: engine.rollback(engine.current_tick - late), 1)
+            times.append(total / 20)
+        print(f"{save_rate:>10}" + ''.join(f"{t*1000:>14.2f}" for t in times))
+    game.STATE_SAVE_RATE = STATE_SAVE_RATE
+
+def allocated_bytes(function):
+    """Calls the function and returns how many bytes were allocated during
+    the call and not yet freed at its peak."""
+    tracemalloc.start()
+    function()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def bench_snapshot(counts=(100, 1000), repeat=50):
+    """Compares saving and restoring a state with Snapshots against the
+    serialize_current_state and load_state round trip rollbacks used before,
+    timing both and measuring how much memory a restore allocates."""
+    LOGGER.setLevel('INFO')
+    print(f"{'entities':>8}{'backend':>10}{'path':>10}{'save ms':>10}{'restore ms':>12}{'restore KiB':>13}")
+    for count in counts:
+        for backend in ("python", "numpy"):
+            engine = populate_engine(count, backend=backend)
+            engine.advance_to(10)
+            for path, save, restore in (
+                ("dicts", engine.serialize_current_state, engine.load_state),
+                ("snapshot", engine.snapshot, engine.restore),
+            ):
+                saved = save()
+                save_time = time_call(save, repeat)
+                restore_time = time_call(lambda: restore(saved), repeat)
+                restore_bytes = allocated_bytes(lambda: restore(saved))
+                print(f"{count:>8}{backend:>10}{path:>10}{save_time*1000:>10.3f}{restore_time*1000:>12.3f}{restore_bytes/1024:>13.1f}")
+
+class CountingPool(EntityPool):
+    """EntityPool that counts the entities it has to build, and can be told
+    not to keep removed entities, the way the engine worked before pooling."""
+
+    def __init__(self, cls, reuse=True):
+        super().__init__(cls)
+        self.reuse = reuse
+        self.built = 0
+
+    def release(self, entity, tick):
+        if self.reuse:
+            super().release(entity, tick)
+
+    def create(self, tick, *args):
+        released = len(self.released)
+        entity = super().create(tick, *args)
+        if len(self.released) == released:
+            self.built += 1
+        return entity
+
+def run_firing(engine, ticks):
+    """Advances the engine with every player firing each tick while running
+    in circles, so projectiles and pickups keep being spawned and removed."""
+    directions = (INPUT_UP, INPUT_UP|INPUT_RIGHT, INPUT_RIGHT, INPUT_DOWN|INPUT_RIGHT,
+                  INPUT_DOWN, INPUT_DOWN|INPUT_LEFT, INPUT_LEFT, INPUT_UP|INPUT_LEFT)
+    players = [e.uid for e in engine.entities.values() if e.kind == EntityKind.PLAYER]
+    for _ in range(ticks):
+        tick = engine.current_tick
+        for i, uid in enumerate(players):
+            engine.register_input(uid, directions[(tick//15 + i) % len(directions)] | INPUT_FIRE, tick)
+        engine.advance_tick()
+
+def gc_pauses(function):
+    """Calls the function and returns how long each garbage collection
+    during the call took, in seconds, keyed by generation."""
+    pauses = {0: [], 1: [], 2: []}
+    started = []
+    def timer(phase, info):
+        if phase == 'start':
+            started.append(time.perf_counter())
+        else:
+            pauses[info['generation']].append(time.perf_counter() - started.pop())
+    gc.callbacks.append(timer)
+    try:
+        function()
+    finally:
+        gc.callbacks.remove(timer)
+    return pauses
+
+def bench_allocations(counts=(100, 1000), warmup=300, ticks=1200):
+    """Compares ticks with players firing every tick, without reusing removed
+    projectiles and pickups, with reuse, and with reuse after freezing the
+    heap the way servers and clients do once they've started up: how many
+    entities each tick builds, how many bytes it allocates, how often full
+    collections run and the longest collection pause. Measured once the
+    engine has run long enough for reuse to start."""
+    LOGGER.setLevel('INFO')
+    print(f"{'entities':>8}{'mode':>8}{'tick ms':>10}{'built/tick':>12}{'KiB/tick':>10}"
+          f"{'full gc/1k ticks':>18}{'max pause ms':>14}")
+    for count in counts:
+        for mode in ("alloc", "pool", "frozen"):
+            if mode == "frozen":
+                game.freeze_heap()
+            engine = populate_engine(count)
+            engine.projectiles = CountingPool(Projectile, mode != "alloc")
+            engine.pickups = CountingPool(Pickup, mode != "alloc")
+            run_firing(engine, warmup)
+            gc.collect()
+            built = engine.projectiles.built + engine.pickups.built
+            start = time.perf_counter()
+            pauses = gc_pauses(lambda: run_firing(engine, ticks))
+            elapsed = time.perf_counter() - start
+            built = engine.projectiles.built + engine.pickups.built - built
+            allocated = allocated_bytes(lambda: run_firing(engine, 100)) / 100
+            gc.unfreeze()
+            longest = max(max(p, default=0) for p in pauses.values())
+            print(f"{count:>8}{mode:>8}{elapsed/ticks*1000:>10.3f}{built/ticks:>12.2f}{allocated/1024:>10.2f}"
+                  f"{len(pauses[2])/ticks*1000:>18.1f}{longest*1000:>14.2f}")
+
+def players_engine(players, seed=0, backend="python"):
+    """Returns an engine holding the given number of players at random
+    positions, and nothing else."""
+    rng = random.Random(seed)
+    engine = game.create_engine(backend)
+    engine.generate_pickup_locations(seed)
+    for i in range(players):
+        engine.add_user(str(i), (to_units(rng.uniform(0, ARENA_SIZE)), to_units(rng.uniform(0, ARENA_SIZE))))
+    return engine
+
+def bench_replay(player_counts=(4, 16, 64), span=60, warmup=240, repeat=10):
+    """Compares how many ticks per second rollbacks re-simulate by advancing
+    tick by tick as usual against the replay path, with players firing every
+    tick. Debug logging is on, as it is by default, but written to devnull."""
+    handlers = [(handler, handler.setStream(open(os.devnull, 'w'))) for handler in LOGGER.handlers
+                if isinstance(handler, logging.StreamHandler)]
+    level = LOGGER.level
+    print(f"{'players':>8}{'backend':>10}{'advance ticks/s':>17}{'replay ticks/s':>16}{'speedup':>9}  same")
+    try:
+        for players in player_counts:
+            for backend in ("python", "numpy"):
+                LOGGER.setLevel('INFO')
+                engine = players_engine(players, backend=backend)
+                run_firing(engine, warmup)
+                LOGGER.setLevel('DEBUG')
+                tick_now = engine.current_tick
+                expected = engine.serialize_current_state()
+                def advance():
+                    engine.rollback_to(tick_now - span)
+                    engine.advance_to(tick_now)
+                advance_time = time_call(advance, repeat)
+                replay_time = time_call(lambda: engine.rollback(tick_now - span), repeat)
+                same = engine.serialize_current_state() == expected
+                print(f"{players:>8}{backend:>10}{span/advance_time:>17,.0f}{span/replay_time:>16,.0f}"
+                      f"{advance_time/replay_time:>8.1f}x  {same}")
+    finally:
+        LOGGER.setLevel(level)
+        for handler, stream in handlers:
+            handler.setStream(stream).close()
+
+class NullServer:
+    """Stands in for the server hosting matches, counting the bytes it would
+    send instead of sending them."""
+
+    def __init__(self):
+        self.sent_bytes = 0
+
+    def send_to(self, user_id, *parts):
+        self.sent_bytes += sum(len(part) for part in parts)
+
+    def user_connected(self, user_id):
+        return True
+
+    def disconnect_user(self, user_id):
+        pass
+
+def bench_matches(counts=(1, 4, 16, 64), players=4, ticks=300):
+    """Plays the given numbers of concurrent matches of scripted players in
+    one process the way a server does: each tick, every player's input
+    message is decoded and handled (rolling back when it arrives late and
+    wasn't predicted), inputs are relayed, and every match is advanced.
+    Player i's inputs arrive i+1 ticks late. Reports how long a server tick
+    takes, and how many matches fit in a tick at FRAMERATE."""
+    level = LOGGER.level
+    LOGGER.setLevel('INFO')
+    print(f"{'matches':>8}{'ms/tick':>10}{'worst ms':>10}{'load':>8}{'relayed KB/s':>14}{'rollbacks/s':>13}")
+    try:
+        for count in counts:
+            server = NullServer()
+            matches = []
+            # encode every input message up front, as clients would have,
+            # keyed by match, player and the tick it arrives at
+            packets = {}
+            for m in range(count):
+                match = game.Match(server, match_id=f'match{m}')
+                for i in range(players):
+                    match.add_player(str(uuid.UUID(int=i+1)))
+                match.announce()
+                match.in_game = True
+                matches.append(match)
+                for i, uid in enumerate(match.players):
+                    inputs = simulate.scripted_inputs(m, i, ticks)
+                    for tick in range(ticks):
+                        window = bytes(inputs[max(0, tick-INPUT_WINDOW+1):tick+1])
+                        packets[match.match_id, uid, tick+i+1] = helpers.marshal_message({"method": "USER_INPUT",
+                            "inputs": [{"user_id": uid, "window": window, "tick": tick}]})
+            server.sent_bytes = 0
+            times = []
+            for tick in range(ticks):
+                start = time.perf_counter()
+                for match in matches:
+                    for uid in match.players:
+                        packet = packets.get((match.match_id, uid, tick))
+                        if packet is not None:
+                            match.handle_message(uid, helpers.unmarshal_message(packet))
+                    match.relay_inputs()
+                    match.advance()
+                    match.verify_clients()
+                times.append(time.perf_counter() - start)
+            elapsed = sum(times)
+            rollbacks = sum(match.engine.rollbacks_performed for match in matches)
+            print(f"{count:>8}{elapsed/ticks*1000:>10.3f}{max(times)*1000:>10.3f}{elapsed/ticks*FRAMERATE:>7.0%}"
+                  f"{server.sent_bytes/1024/(ticks/FRAMERATE):>14,.1f}{rollbacks/(ticks/FRAMERATE):>13,.0f}")
+        print(f"one process sustains about {int(count*ticks/(elapsed*FRAMERATE))} concurrent {players}-player "
+              f"matches at {FRAMERATE} ticks/s")
+    finally:
+        LOGGER.setLevel(level)
+
+class PairServer(NullServer):
+    """Stands in for the server hosting a match, sending each player's
+    packets through a PacketWriter over a socket pair, the other end of
+    which is drained and counted."""
+
+    def __init__(self):
+        super().__init__()
+        self.user_writers = {}
+        self.receivers = []
+
+    def connect(self, user_id):
+        sock, receiver = socket.socketpair()
+        sock.setblocking(False)
+        self.user_writers[user_id] = helpers.PacketWriter(sock)
+        self.receivers.append(receiver)
+
+    def send_to(self, user_id, *parts):
+        self.user_writers[user_id].push(*parts)
+
+    def drain(self):
+        """Reads everything sent so far, counting it in sent_bytes."""
+        for writer, receiver in zip(self.user_writers.values(), self.receivers):
+            while True:
+                try:
+                    self.sent_bytes += len(receiver.recv(0x10000, socket.MSG_DONTWAIT))
+                except BlockingIOError:
+                    if writer.flush():
+                        break
+
+    def close(self):
+        for writer, receiver in zip(self.user_writers.values(), self.receivers):
+            writer.socket.close()
+            receiver.close()
+
+def legacy_relay_inputs(match):
+    """Relays inputs the way Match.relay_inputs used to: every input handled
+    is marshalled into one packet, which is sent to every player, including
+    those whose inputs it holds."""
+    match.apply_late_inputs()
+    if match.user_inputs:
+        packet = helpers.marshal_message({"method": "USER_INPUT", "inputs": list(match.user_inputs)})
+        for user_id in list(match.players):
+            match.send(user_id, packet)
+        match.user_inputs = []
+
+def bench_fanout(player_counts=(2, 4, 8, 16), rounds=2000):
+    """Compares relaying every player's input to the rest of a match the way
+    it used to be done, with one packet marshalled and sent to everyone,
+    against Match.relay_inputs, sent over socket pairs. Each round, every
+    player sends one input window, and the inputs are relayed at once.
+    Reports the time per relayed input and the bytes sent for it."""
+    level = LOGGER.level
+    LOGGER.setLevel('INFO')
+    print(f"{'players':>8}{'relay':>8}{'us/input':>10}{'bytes/input':>13}")
+    try:
+        for players in player_counts:
+            for name, relay in (("legacy", legacy_relay_inputs), ("fanout", game.Match.relay_inputs)):
+                server = PairServer()
+                match = game.Match(server, match_id='fanout')
+                for i in range(players):
+                    server.connect(str(uuid.UUID(int=i+1)))
+                    match.add_player(str(uuid.UUID(int=i+1)))
+                match.announce()
+                server.drain()
+                server.sent_bytes = 0
+                messages = [{"method": "USER_INPUT", "inputs": [{"user_id": uid, "tick": INPUT_WINDOW,
+                    "window": bytes(simulate.scripted_inputs(i, 0, INPUT_WINDOW))}]}
+                    for (i, uid) in enumerate(match.players)]
+                elapsed = 0
+                for _ in range(rounds):
+                    for uid, message in zip(match.players, messages):
+                        match.handle_message(uid, message)
+                    start = time.perf_counter()
+                    relay(match)
+                    elapsed += time.perf_counter() - start
+                    server.drain()
+                server.close()
+                relayed = rounds * players
+                print(f"{players:>8}{name:>8}{elapsed/relayed*1e6:>10.2f}{server.sent_bytes/relayed:>13.1f}")
+    finally:
+        LOGGER.setLevel(level)
+
+def legacy_tick_loop(seconds, work):
+    """Runs ticks for the given number of seconds the way server.py used
+    to: waiting until a tick length has passed since the last one ran, then
+    running one and counting from then. Returns how many ticks ran."""
+    ticks = 0
+    start = last_tick = time.monotonic()
+    while (t := time.monotonic()) - start < seconds:
+        time.sleep(max(0, last_tick + 1/FRAMERATE - t))
+        t = time.monotonic()
+        if t - last_tick >= 1/FRAMERATE:
+            last_tick = t
+            ticks += 1
+            work()
+    return ticks
+
+def scheduled_tick_loop(seconds, work):
+    """Runs ticks for the given number of seconds with a TickScheduler.
+    Returns how many ticks ran, and the scheduler."""
+    ticks = 0
+    scheduler = ticker.TickScheduler()
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        for _ in range(scheduler.wait()):
+            ticks += 1
+            work()
+    return ticks, scheduler
+
+def bench_ticks(loads=(0.25, 0.75, 1.25), seconds=2):
+    """Runs a loop ticking at FRAMERATE, where each tick does work taking a
+    random time averaging the given fraction of a tick length, the way
+    server.py used to and with a TickScheduler. Reports how many ticks each
+    ran per second and how far behind the clock it ended up, along with the
+    scheduler's jitter statistics."""
+    level = LOGGER.level
+    LOGGER.setLevel('INFO')
+    print(f"{'load':>6}{'loop':>11}{'ticks/s':>9}{'behind':>8}{'jitter ms':>11}{'max ms':>8}{'caught up':>11}{'dropped':>9}")
+    try:
+        for load in loads:
+            rng = random.Random(0)
+            work = lambda: time.sleep(rng.uniform(0, 2*load/FRAMERATE))
+            ticks = legacy_tick_loop(seconds, work)
+            print(f"{load:>6.0%}{'legacy':>11}{ticks/seconds:>9.1f}{seconds*FRAMERATE - ticks:>8.0f}")
+            rng = random.Random(0)
+            ticks, scheduler = scheduled_tick_loop(seconds, work)
+            stats = scheduler.stats()
+            print(f"{load:>6.0%}{'scheduler':>11}{ticks/seconds:>9.1f}{seconds*FRAMERATE - ticks:>8.0f}"
+                  f"{stats['mean_jitter_ms']:>11.2f}{stats['max_jitter_ms']:>8.2f}{stats['caught_up']:>11}{stats['dropped']:>9}")
+    finally:
+        LOGGER.setLevel(level)
+
+BENCHMARKS = {
+    "codec": bench_codec,
+    "collisions": bench_collisions,
+    "backends": bench_backends,
+    "rollback": bench_rollback,
+    "snapshot": bench_snapshot,
+    "allocations": bench_allocations,
+    "replay": bench_replay,
+    "matches": bench_matches,
+    "fanout": bench_fanout,
+    "ticks": bench_ticks,
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Usage: benchmark.py [{'|'.join(BENCHMARKS)}]...")
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,9 @@ import time
 import pygame
 
 import game
-from globalvars import EXTRA_CLIENT_LATENCY, FRAMERATE, LOGGER, SERVER_HOST, SERVER_PORT, SKIP_INTRO
+import ticker
+from fixedpoint import to_units
+from globalvars import EXTRA_CLIENT_LATENCY, LOGGER, SERVER_HOST, SERVER_PORT, SKIP_INTRO
 
 def main():
     host = SERVER_HOST
@@ -17,11 +19,15 @@ def main():
     game_client = game.GameClient(server_host=host,server_port=port,display=True,extra_latency=EXTRA_CLIENT_LATENCY)
     if not SKIP_INTRO:
         game_client.play_intro()
+    # everything loaded so far lives as long as the client does
+    game.freeze_heap()
     game_state = "title"
 
+    ticks = ticker.TickScheduler()
     while True:
-        # lock the global framerate
-        game_client.display.tick(FRAMERATE)
+        # wait for the next tick, and find out how many are due if drawing
+        # the last frame made us fall behind
+        due = ticks.wait()
 
         # client behavior based on client state
         if game_state == "title": # if we're on the title screen
@@ -41,8 +47,8 @@ def main():
                 game_client.join_game()
                 # initialize waiting room
                 game_client.start_game(time.time()) # random seed value for waiting room
-                player = game_client.engine.add_user(game_client.player_id, (100, 100))
-                game_client.engine.add_user(1, (500, 500))
+                player = game_client.engine.add_user(game_client.player_id, (to_units(100), to_units(100)))
+                game_client.engine.add_user(1, (to_units(500), to_units(500)))
                 game_state = "waiting"
             else:
                 game_client.display.add_message('Failed to connect to server.')
@@ -63,11 +69,12 @@ def main():
                     player = game_client.get_player()
                     start_time = time.time() + msg['start_in']
                     game_state = "countdown"
-            # get input
-            game_client.process_input()
-            #game_client.send_input()
-            # update game state
-            game_client.advance_game()
+            for _ in range(due):
+                # get input
+                game_client.process_input()
+                #game_client.send_input()
+                # update game state
+                game_client.advance_game()
             game_client.update_scoreboard()
             # draw game
             game_client.display.focus_entity(player)
@@ -97,9 +104,11 @@ def main():
             if game_client.recv_end():
                 # we've reached the end of a match, return to title screen
                 game_state = "title"
-            # process local events
-            game_client.process_input()
-            game_client.advance_game()
+                ticks.log_stats('client ticks')
+            # process local events, and run every tick that's due
+            for _ in range(due):
+                game_client.process_input()
+                game_client.advance_game()
             game_client.update_scoreboard()
             # draw game state to screen
             game_client.display.focus_entity(game_client.get_player())
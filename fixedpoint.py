@@ -0,0 +1,51 @@
+"""Arithmetic on the units entity positions, velocities, directions and sizes
+are kept in.
+
+With FIXED_POINT set, a unit is 1/ONE of a pixel and every value is an
+integer, so the simulation only does integer math and gives bit-identical
+results on every node. Products and quotients are truncated towards zero.
+Otherwise a unit is a pixel, and values are floats."""
+
+from globalvars import FIXED_POINT, FIXED_POINT_BITS
+
+# How many units make up a pixel.
+ONE = 1 << FIXED_POINT_BITS if FIXED_POINT else 1
+
+def to_units(pixels):
+    """Converts a number of pixels to units."""
+    if FIXED_POINT:
+        return int(pixels * ONE)
+    return pixels
+
+def to_pixels(units):
+    """Converts a number of units to pixels, e.g. for drawing."""
+    if FIXED_POINT:
+        return units / ONE
+    return units
+
+def ratio(numerator, denominator):
+    """Returns the ratio of two integers in units."""
+    if FIXED_POINT:
+        return numerator * ONE // denominator
+    return numerator / denominator
+
+def mul(a, b):
+    """Multiplies two values in units."""
+    if FIXED_POINT:
+        product = a * b
+        return product // ONE if product >= 0 else -(-product // ONE)
+    return a * b
+
+def div(a, b):
+    """Divides a value in units by another."""
+    if FIXED_POINT:
+        quotient = abs(a * ONE) // abs(b)
+        return quotient if (a >= 0) == (b > 0) else -quotient
+    return a / b
+
+def whole(a):
+    """Truncates a value in units to a whole number of pixels."""
+    if FIXED_POINT:
+        pixels = abs(a) // ONE * ONE
+        return pixels if a >= 0 else -pixels
+    return int(a)
@@ -1,18 +1,38 @@
 """Class definitions for running, hosting, and drawing the game."""
 
-import random
 import pygame, pygame.font, pygame.time
 import time
 import sys
 import math
+import bisect
+import gc
+import heapq
 import socket
 import uuid
 import select
+import selectors
+import struct
+import zlib
+from collections import deque
 
 from globalvars import *
 import helpers
-from game_objects import Pickup, Player,EntityKind,deserialize_entity
-
+from fixedpoint import to_pixels, to_units
+from game_objects import EntityPool, Pickup, PickupPositions, Player, Projectile, EntityKind, deserialize_entity
+from history import InputHistory, Snapshot, SnapshotRing
+from spatial import CollisionGrid
+
+# Fields of the game state besides its entities that go into checksums: tick,
+# pickups generated, live pickups and the next entity ID.
+CHECKSUM_HEADER = struct.Struct('!qqqq')
+
+# Input bits set while each movement key is held down.
+MOVEMENT_KEYS = {
+    pygame.K_w: INPUT_UP,
+    pygame.K_a: INPUT_LEFT,
+    pygame.K_s: INPUT_DOWN,
+    pygame.K_d: INPUT_RIGHT,
+}
 
 class GameDisplay:
     """Renders the game state to the screen."""
@@ -33,10 +53,6 @@ class GameDisplay:
         self.max_messages = 5
         self.messages = []
     
-    def tick(self, framerate):
-        """Ticks the pygame clock forward to lock the framerate."""
-        self.clock.tick(framerate)
-    
     def get_center_pos(self, font, text, ypos):
         """Returns the top-left position to render text at the center of the screen
         with the given font, string, and vertical position."""
@@ -232,11 +248,12 @@ class GameDisplay:
     def focus_entity(self, entity):
         """Center camera on entity by setting camera position to entity's position."""
         x,y = entity.position
-        self.camera_pos = (x-SCREEN_WIDTH/2, y-SCREEN_HEIGHT/2)
-        self.camera_pos = (x,y)
+        self.camera_pos = (to_pixels(x), to_pixels(y))
 
     def world_to_screen_pos(self, position):
+        """Converts a position in the world, in units, to one on screen."""
         x,y = position
+        x,y = to_pixels(x), to_pixels(y)
         cam_x, cam_y = self.camera_pos
         p = (x-cam_x+SCREEN_WIDTH/2, y-cam_y+SCREEN_HEIGHT/2)
         return p
@@ -286,52 +303,163 @@ class GameEngine:
 
     def __init__(self):
         self.input_delay = GLOBAL_INPUT_DELAY
+        self.collision_grid = CollisionGrid()
         self.reset_game()
 
     def reset_game(self):
         """Sets up or resets variables needed to start a game."""
         self.current_tick = 0
+        # entities keyed by their entity ID, and the IDs in use in order,
+        # which is the order entities are simulated in
         self.entities = {}
-        self.inputs = {}
-        self.frames = {}
-        self.pickup_positions = []
+        self.entity_ids = []
+        # entity IDs are handed out lowest first: every ID below this one
+        # belongs to an entity, or is in the heap of free IDs
+        self.next_entity_id = 0
+        self.free_ids = []
+        # packed input of each player for the ticks around the current one
+        self.inputs = InputHistory()
+        # how many late inputs made us roll back, and how many didn't
+        # because they matched what we predicted
+        self.rollbacks_performed = 0
+        self.rollbacks_avoided = 0
+        # running totals of the rollbacks performed: how many ticks had any,
+        # the most during one tick, the deepest, and the ticks re-simulated
+        self.rollback_ticks = 0
+        self.most_rollbacks_per_tick = 0
+        self.deepest_rollback = 0
+        self.ticks_resimulated = 0
+        # tick the last rollback was performed during, and how many were
+        self.last_rollback_tick = None
+        self.last_tick_rollbacks = 0
+        # saved states to roll back to, covering the last MAX_ROLLBACK_TICKS
+        self.frames = SnapshotRing()
+        # checksum of the state at the start of every tick of the last
+        # MAX_ROLLBACK_TICKS that clients report checksums for
+        self.checksums = SnapshotRing()
+        # set while re-simulating ticks after rolling back
+        self.replaying = False
+        # removed projectiles and pickups, reused for new ones
+        self.projectiles = EntityPool(Projectile)
+        self.pickups = EntityPool(Pickup)
+        self.pickup_positions = PickupPositions(0)
         self.pickups_generated = 0
         self.live_pickups = 0
 
     def serialize_current_state(self):
         """Returns a dict representing the current state of the game."""
         return {
-            "entities": [e.serialize() for e in self.entities.values()],
+            "entities": [self.entities[eid].serialize() for eid in self.entity_ids],
             "tick": self.current_tick,
             "generated": self.pickups_generated,
-            "live": self.live_pickups
+            "live": self.live_pickups,
+            "next_eid": self.next_entity_id
         }
 
-    def register_state(self, game_state=None):
-        """Saves a state of the game to the engine. If a game state
-        dict is not passed, it will save the current state of the game."""
-        if game_state is None:
-            game_state = self.serialize_current_state()
-        self.frames[game_state['tick']] = game_state
+    def checksum(self):
+        """Returns a checksum of the current state of the game. Entity
+        checksums are summed, so it doesn't depend on the order entities are
+        stored in, and two engines agree on it if they agree on the state."""
+        header = CHECKSUM_HEADER.pack(self.current_tick, self.pickups_generated, self.live_pickups, self.next_entity_id)
+        return (zlib.crc32(header) + self.entities_checksum()) & 0xFFFFFFFF
+
+    def entities_checksum(self):
+        """Returns the sum of the checksums of every entity."""
+        return sum(e.checksum() for e in self.entities.values())
+
+    def register_state(self):
+        """Saves the current state of the game to roll back to, reusing
+        the snapshot it replaces in the ring buffer."""
+        self.frames[self.current_tick] = self.snapshot(self.frames.reusable(self.current_tick))
+
+    def snapshot(self, snapshot=None):
+        """Returns a Snapshot of the current state of the game, filling in
+        the given one if there is one."""
+        if snapshot is None:
+            snapshot = Snapshot()
+        snapshot.tick = self.current_tick
+        snapshot.generated = self.pickups_generated
+        snapshot.live = self.live_pickups
+        snapshot.next_eid = self.next_entity_id
+        snapshot.entities[:] = self.entities.values()
+        snapshot.fields[:] = [e.snapshot() for e in snapshot.entities]
+        return snapshot
+
+    def restore(self, snapshot):
+        """Returns the game to the state saved in a Snapshot, writing the
+        saved fields back into the same entities."""
+        self.current_tick = snapshot.tick
+        self.pickups_generated = snapshot.generated
+        self.live_pickups = snapshot.live
+        self.next_entity_id = snapshot.next_eid
+        self.entities.clear()
+        for entity, fields in zip(snapshot.entities, snapshot.fields):
+            entity.restore(fields)
+            self.entities[entity.eid] = entity
+        self.reclaim_free_ids()
+        self.projectiles.forget_since(snapshot.tick)
+        self.pickups.forget_since(snapshot.tick)
 
     def register_input(self, uid, user_input, tick):
-        """Adds a set of input corresponding to a single tick."""
-        if tick not in self.inputs:
-            self.inputs[tick] = {}
-        self.inputs[tick][uid] = user_input
+        """Adds the packed input of a single user for a single tick. Returns
+        True if this changed the input we had for that tick. Input too old to
+        roll back for, or scheduled too far ahead to keep, is dropped."""
+        if not self.current_tick - MAX_ROLLBACK_TICKS <= tick <= self.current_tick + MAX_INPUT_LEAD:
+            return False
+        return self.inputs.record(uid, tick, user_input)
+
+    def register_input_window(self, uid, window, tick):
+        """Adds a window of packed inputs for a single user, one byte per tick,
+        ending at the given tick. Returns the earliest tick whose input changed,
+        or None if we already had all of them or predicted them correctly."""
+        earliest = None
+        confirmed_prediction = False
+        first_tick = tick - len(window) + 1
+        for offset, user_input in enumerate(window):
+            if first_tick+offset < self.current_tick and self.inputs.is_predicted(first_tick+offset, uid):
+                confirmed_prediction = True
+            if self.register_input(uid, user_input, first_tick+offset) and earliest is None:
+                earliest = first_tick+offset
+        if confirmed_prediction and (earliest is None or earliest >= self.current_tick):
+            self.rollbacks_avoided += 1
+        return earliest
+
+    def confirmed_tick(self):
+        """Returns the newest tick we have every player's input for, or None
+        if there's a player we haven't had any input from yet."""
+        ticks = [self.inputs.latest_tick(e.uid) for e in self.entities.values() if e.kind == EntityKind.PLAYER]
+        if None in ticks:
+            return None
+        return min(ticks, default=None)
+
+    def final_tick(self):
+        """Returns the newest tick whose state can't change any more, since we
+        have every player's input for the ticks before it, or None if there
+        isn't one."""
+        confirmed = self.confirmed_tick()
+        if confirmed is None:
+            return None
+        return min(confirmed+1, self.current_tick)
     
     def load_state(self, game_state):
         """Load the given game state to the current tick.  If one is not 
         given, load the most recent game state we've been given."""
         if game_state is not None:
-            self.frames[game_state['tick']] = game_state
             self.current_tick = game_state['tick']
             self.pickups_generated = game_state['generated']
             self.live_pickups = game_state['live']
+            self.next_entity_id = game_state['next_eid']
             self.entities = {}
-            for e in game_state['entities']:
+            for e in sorted(game_state['entities'], key=lambda e: e['eid']):
                 entity = deserialize_entity(e)
-                self.entities[id(entity)] = entity
+                self.entities[entity.eid] = entity
+            self.reclaim_free_ids()
+            # saved snapshots may still refer to removed entities from ticks
+            # after this one
+            self.projectiles.clear()
+            self.pickups.clear()
+            self.register_state()
+            self.record_checksum()
 
     def advance_tick(self):
         """Advances the game by one tick, updating the positions and states
@@ -342,27 +470,27 @@ class GameEngine:
 
         to_delete = set()
         to_add = []
-        for entity_id in self.entities:
+        # calculate collisions, using positions from the start of the tick
+        collisions = self.check_collisions()
+        for entity_id in self.entity_ids:
             entity = self.entities[entity_id]
 
-            # calculate collisions
-            collisions = self.check_collisions()
-
             # process this frame's input
             if entity.kind == EntityKind.PLAYER:
-                if self.current_tick in self.inputs and entity.uid in self.inputs[self.current_tick]:
-                    entity.update_velocity(self.inputs[self.current_tick][entity.uid])
-                    if self.inputs[self.current_tick][entity.uid]['fired']:
-                        p = entity.shoot_projectile()
-                        if p is not None:
-                            to_add.append(p)
+                user_input = self.inputs.input_for(self.current_tick, entity.uid)
+                if user_input is not None:
+                    entity.update_velocity(user_input)
+                    if user_input & INPUT_FIRE:
+                        proj_vel = entity.projectile_velocity()
+                        if proj_vel is not None:
+                            to_add.append(self.projectiles.create(self.current_tick, entity.uid, entity.position, proj_vel))
                 else:
                     entity.update_velocity()
 
             # process projectile collisions
             if entity.kind == EntityKind.PROJECTILE:
-                if id(entity) in collisions:
-                    _colls = collisions[id(entity)]
+                if entity_id in collisions:
+                    _colls = collisions[entity_id]
                     for collided in _colls:
                         if collided.kind == EntityKind.PLAYER and collided.uid != entity.owner_uid:
                             collided.take_hit(entity)
@@ -375,8 +503,8 @@ class GameEngine:
                     to_delete.add(entity)
             
             if entity.kind == EntityKind.PICKUP:
-                if id(entity) in collisions:
-                    _colls = collisions[id(entity)]
+                if entity_id in collisions:
+                    _colls = collisions[entity_id]
                     for collided in _colls:
                         if collided.kind == EntityKind.PLAYER:
                             collided.collect_pickup(entity)
@@ -393,46 +521,37 @@ class GameEngine:
         # cull entities
         for e in to_delete:
             self.remove_entity(e)
-            LOGGER.debug('deleting %s', entity)
+            if not self.replaying:
+                LOGGER.debug('deleting %s', e)
         # add entities
-        for e in to_add:
-            self.add_entity(e)
+        self.add_entities(to_add)
 
         # advance tick
         self.current_tick += 1
+        self.record_checksum()
+
+    def record_checksum(self):
+        """Saves the checksum of the current state, if it's for a tick that
+        clients report checksums for."""
+        if self.current_tick % CHECKSUM_RATE == 0:
+            self.checksums[self.current_tick] = self.checksum()
 
     def check_collisions(self):
-        """Checks all combinations of entities for collisions with other entities.
+        """Checks all entities for collisions with other entities, using a
+        uniform grid so only nearby entities are compared.
         
-        Returns a dict, where keys are the id of each Entity and the values are a list 
+        Returns a dict, where keys are the entity ID of each Entity and the values are a list 
         of other entities the Entity has collided with."""
-        # this is O(N^2)... we can turn it into an O(N) algorithm
-        # with something like the GJK distance algorithm, but we'll
-        # cross that bridge when we get to it
-        all_collisions = {}
-        for entity_id in self.entities:
-            entity = self.entities[entity_id]
-            collisions = []
-            for entity_id2 in self.entities:
-                if entity_id2 == entity_id:
-                    continue
-                other = self.entities[entity_id2]
-                if self.collided(entity, other):
-                    collisions.append(other)
-            if collisions:
-                all_collisions[entity_id] = collisions
-        return all_collisions
+        return self.collision_grid.find_collisions([self.entities[eid] for eid in self.entity_ids])
     
     def collided(self, a, b):
         """Checks whether two Entities A and B have collided by
-        comparing the distance between their centres with their
-        respective sizes."""
+        comparing the squared distance between their centres with
+        the square of their combined sizes."""
         ax,ay = a.position
         bx,by = b.position
-        distance = ( (ax-bx)**2 + (ay-by)**2 )**0.5
-        # if distance minus both sizes is zero, the entities
-        # have collided
-        return ((distance - a.size - b.size) < 0)
+        reach = a.size + b.size
+        return (ax-bx)**2 + (ay-by)**2 < reach*reach
 
     def add_user(self, uid, position=(0,0)):
         """Adds a user to a waiting or ongoing match."""
@@ -449,59 +568,154 @@ class GameEngine:
         """Recalculates the current game state according to recorded inputs,
         starting at begin_tick."""
         tick_now = self.current_tick
+        self.rollbacks_performed += 1
+        depth = tick_now - begin_tick
+        if tick_now != self.last_rollback_tick:
+            self.last_rollback_tick = tick_now
+            self.last_tick_rollbacks = 0
+            self.rollback_ticks += 1
+        self.last_tick_rollbacks += 1
+        self.most_rollbacks_per_tick = max(self.most_rollbacks_per_tick, self.last_tick_rollbacks)
+        self.deepest_rollback = max(self.deepest_rollback, depth)
+        self.ticks_resimulated += depth
         self.rollback_to(begin_tick=begin_tick)
-        self.advance_to(tick_now)
+        self.replay_to(tick_now)
+
+    def rollback_stats(self):
+        """Summarizes the rollbacks performed so far: how many ticks had any,
+        the most performed during one tick, the mean and deepest number of
+        ticks rolled back, and the total number of ticks re-simulated."""
+        return {
+            "rollbacks": self.rollbacks_performed,
+            "ticks": self.rollback_ticks,
+            "most_per_tick": self.most_rollbacks_per_tick,
+            "mean_depth": self.ticks_resimulated / max(1, self.rollbacks_performed),
+            "max_depth": self.deepest_rollback,
+            "resimulated": self.ticks_resimulated,
+        }
+
+    def log_rollback_stats(self, label):
+        """Logs rollback_stats(), along with how many rollbacks were avoided."""
+        stats = self.rollback_stats()
+        LOGGER.debug('%s: rollbacks performed: %d in %d ticks (at most %d in one), avoided: %d, '
+            'depth: mean %.1f, max %d, ticks re-simulated: %d', label, stats['rollbacks'], stats['ticks'],
+            stats['most_per_tick'], self.rollbacks_avoided, stats['mean_depth'], stats['max_depth'],
+            stats['resimulated'])
 
     def rollback_to(self, begin_tick=0):
         """Rolls the game state back to what it was at the specified tick. If 
         we don't have a game state from that tick, load from the next 
-        earliest tick."""
-        while begin_tick not in self.frames:
-            begin_tick -= 1
-        self.load_state(self.frames[begin_tick])
+        earliest tick, or the oldest one we still have if it's after the
+        specified tick. A state left over from before that is out of
+        rollback range, and may refer to entities that have been reused
+        since, so it's never restored."""
+        snapshot = self.frames.latest_at(begin_tick)
+        if snapshot is None:
+            LOGGER.debug('no saved state at or before tick %d', begin_tick)
+            snapshot = self.frames.oldest()
+            if snapshot is not None and snapshot.tick < begin_tick:
+                LOGGER.debug('oldest saved state, at tick %d, is out of rollback range', snapshot.tick)
+                return
+        if snapshot is not None:
+            self.restore(snapshot)
 
     def advance_to(self, tick):
         """Advances the game state to the specified tick."""
         while self.current_tick < tick:
             self.advance_tick()
 
+    def replay_to(self, tick):
+        """Re-simulates ticks up to the specified tick after rolling back,
+        reaching the same state advance_to would, but without logging what
+        happens in ticks we've already simulated once."""
+        self.replaying = True
+        try:
+            while self.current_tick < tick:
+                self.advance_tick()
+        finally:
+            self.replaying = False
+
     def add_entity(self, entity):
-        self.entities[id(entity)] = entity
+        """Adds an entity to the game, giving it the lowest free entity ID if
+        it doesn't have one yet."""
+        if entity.eid is None:
+            entity.eid = self.next_eid()
+        self.insert_entities((entity,))
         return entity
-    
+
+    def add_entities(self, entities):
+        """Adds several entities to the game, as add_entity does one."""
+        for entity in entities:
+            if entity.eid is None:
+                entity.eid = self.next_eid()
+        self.insert_entities(entities)
+
+    def insert_entity(self, entity):
+        """Puts an entity in the entities dict, and its ID in entity_ids."""
+        self.insert_entities((entity,))
+
+    def insert_entities(self, entities):
+        """Puts entities in the entities dict, and their IDs in entity_ids,
+        in order."""
+        for entity in entities:
+            self.entities[entity.eid] = entity
+            bisect.insort(self.entity_ids, entity.eid)
+
+    def release_eid(self, eid):
+        """Frees the ID of an entity taken out of the game."""
+        del self.entity_ids[bisect.bisect_left(self.entity_ids, eid)]
+        heapq.heappush(self.free_ids, eid)
+
     def remove_entity(self, entity):
-        return self.entities.pop(id(entity))
+        """Takes an entity out of the game, freeing its entity ID, and hands
+        projectiles and pickups back to their pool."""
+        self.release_eid(entity.eid)
+        if entity.kind == EntityKind.PROJECTILE:
+            self.projectiles.release(entity, self.current_tick)
+        elif entity.kind == EntityKind.PICKUP:
+            self.pickups.release(entity, self.current_tick)
+        return self.entities.pop(entity.eid)
+
+    def next_eid(self):
+        """Hands out the lowest entity ID not in use."""
+        if self.free_ids:
+            return heapq.heappop(self.free_ids)
+        self.next_entity_id += 1
+        return self.next_entity_id - 1
+
+    def reclaim_free_ids(self):
+        """Rebuilds the heap of free entity IDs, and entity_ids, from the
+        entities in the game."""
+        self.free_ids = [eid for eid in range(self.next_entity_id) if eid not in self.entities]
+        self.entity_ids = [eid for eid in range(self.next_entity_id) if eid in self.entities]
     
     def place_players(self):
         """Places all players at starting positions."""
         players = [e for e in self.entities.values() if e.kind == EntityKind.PLAYER]
         if not players:
             return
-        offset = PLAYER_START_OFFSET+players[0].size
+        offset = to_units(PLAYER_START_OFFSET)+players[0].size
+        far = to_units(ARENA_SIZE)-offset
         if len(players) > 0:
             players[0].position = (offset, offset)
         if len(players) > 1:
-            players[1].position = (ARENA_SIZE-offset, ARENA_SIZE-offset)
+            players[1].position = (far, far)
         if len(players) > 2:
-            players[2].position = (ARENA_SIZE-offset, offset)
+            players[2].position = (far, offset)
         if len(players) > 3:
-            players[3].position = (offset, ARENA_SIZE-offset)
+            players[3].position = (offset, far)
 
     def generate_pickup_locations(self, seed):
-        """Deterministically generates a list of pickup positions from the given seed."""
+        """Deterministically picks the stream of pickup positions from the given seed."""
         LOGGER.debug('generating positions from %s', seed)
-        self.pickup_positions = []
-        random.seed(seed)
-        for p in range(PICKUP_POSITIONS_GENERATED):
-            x = random.randrange(PICKUP_SIZE, ARENA_SIZE-PICKUP_SIZE)
-            y = random.randrange(PICKUP_SIZE, ARENA_SIZE-PICKUP_SIZE)
-            self.pickup_positions.append((x,y))
+        self.pickup_positions = PickupPositions(seed)
 
     def spawn_pickup(self):
-        """Creates a new pickup at the next position in the pickup position list."""
-        position = self.pickup_positions[self.pickups_generated % len(self.pickup_positions)]
-        LOGGER.debug('spawning pickup: %s', str(position))
-        self.add_entity(Pickup(position))
+        """Creates a new pickup at the next position in the pickup position stream."""
+        position = self.pickup_positions[self.pickups_generated]
+        if not self.replaying:
+            LOGGER.debug('spawning pickup: %s', position)
+        self.add_entity(self.pickups.create(self.current_tick, position))
         self.pickups_generated += 1
         self.live_pickups += 1
     
@@ -511,6 +725,27 @@ class GameEngine:
         return {
             e.uid : e.score for (e_id, e) in self.entities.items() if e.kind == EntityKind.PLAYER
         }
+
+def freeze_heap():
+    """Collects garbage, then moves every object still alive into the
+    garbage collector's permanent generation. Meant to be called once, when
+    a server or client process has finished starting up, so that full
+    collections later on don't look at the modules, assets and other objects
+    that live as long as the process, instead of pausing long enough to
+    drop frames."""
+    gc.collect()
+    gc.freeze()
+
+def create_engine(backend=ENGINE_BACKEND):
+    """Returns a new game engine using the given backend. Falls back to the
+    pure Python engine if the NumPy one can't be used, which is safe since both
+    produce the same game states."""
+    if backend == "numpy":
+        from array_engine import ArrayGameEngine, np
+        if np is not None:
+            return ArrayGameEngine()
+        LOGGER.debug('NumPy is not installed, using the python engine backend')
+    return GameEngine()
     
 class GameClient:
     """Faciliates communication between the user and the server's game states."""
@@ -522,18 +757,23 @@ class GameClient:
         # How many ticks to manually delay responses by.
         self.extra_latency = extra_latency
         self.socket = None
-        self.engine = GameEngine()
-        self.input_state = {
-            pygame.K_w : False,
-            pygame.K_a : False,
-            pygame.K_s : False,
-            pygame.K_d : False,
-            'fired': False
-        }
+        self.reader = None
+        self.engine = create_engine()
+        # input bits of the movement keys currently held down
+        self.input_state = 0
+        # packed inputs of the last INPUT_WINDOW ticks we scheduled, oldest
+        # first, and the tick the newest one is scheduled for
+        self.input_window = deque(maxlen=INPUT_WINDOW)
+        self.input_window_tick = None
         self.player_id = 0
         self.match_id = 0
         self.incoming_messages = []
         self.outgoing_messages = []
+        # game states received from the server that it may send deltas
+        # against, keyed by tick
+        self.state_history = {}
+        # latest tick we've reported a state checksum for
+        self.checksum_tick = -1
         self.scoreboard = {}
         # Whether we're in a waiting room or a real match.
         self.live_match = False
@@ -585,41 +825,38 @@ class GameClient:
         return None
 
     def get_input(self):
-        input_state = dict(self.input_state)
-        input_state['fired'] = False
+        """Processes pending pygame events, and returns this tick's input
+        packed as INPUT_* bits."""
+        fired = 0
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN:
-                if event.key in self.input_state:
-                    input_state[event.key] = True
+                if event.key in MOVEMENT_KEYS:
+                    self.input_state |= MOVEMENT_KEYS[event.key]
                 if event.key == pygame.K_SPACE:
-                    input_state['fired'] = True
+                    fired = INPUT_FIRE
             elif event.type == pygame.KEYUP:
-                if event.key in self.input_state:
-                    input_state[event.key] = False
+                if event.key in MOVEMENT_KEYS:
+                    self.input_state &= ~MOVEMENT_KEYS[event.key]
             elif event.type == pygame.QUIT:
                 sys.exit()
-        return input_state
+        return self.input_state | fired
     
     def process_input(self):
-        """Gets input from the user, registers it in the dict of all inputs,
-        then sends it to the server."""
-        # get current input state
-        new_state = self.get_input()
-
-        # check if this is different from last frame's input
-        changed = False
-        for key in self.input_state:
-            if new_state[key] != self.input_state[key]:
-                changed = True
-
-        # record/send input to server only if there's been a change
-        if changed:
-            tick = self.engine.current_tick + GLOBAL_INPUT_DELAY
-            self.input_state = new_state
-            if self.live_match:
-                self.send_input(tick)
-            # send input to game engine
-            self.engine.register_input(self.player_id, self.input_state, tick)
+        """Gets input from the user, registers it with the game engine, then
+        sends it to the server along with the inputs of the last few ticks."""
+        tick = self.engine.current_tick + GLOBAL_INPUT_DELAY
+        user_input = self.get_input()
+
+        # start a new window if we've skipped ahead (e.g. after a resync)
+        if self.input_window_tick is None or tick != self.input_window_tick + 1:
+            self.input_window.clear()
+        self.input_window.append(user_input)
+        self.input_window_tick = tick
+
+        if self.live_match:
+            self.send_input(tick)
+        # send input to game engine
+        self.engine.register_input(self.player_id, user_input, tick)
     
     def recv_state(self):
         """Checks if there is a game state update from the server, if so,
@@ -628,31 +865,50 @@ class GameClient:
         for message in self.incoming_messages:
             if message['method'] == "GAME_STATE":
                 LOGGER.debug('received game state from server')
-                self.engine.load_state(message['state'])
+                self.load_delta(message['delta'])
             else:
                 remaining_messages.append(message)
         self.incoming_messages = remaining_messages
+
+    def load_delta(self, delta):
+        """Rebuilds a game state from a delta against a state we've acknowledged,
+        loads it and re-simulates up to our current tick, then acknowledges the
+        new state so the server can send deltas against it."""
+        baseline = None
+        if delta['baseline'] is not None:
+            if delta['baseline'] not in self.state_history:
+                LOGGER.debug('missing baseline state for tick %d', delta['baseline'])
+                return
+            baseline = self.state_history[delta['baseline']]
+        state = helpers.apply_delta(baseline, delta)
+
+        # the server won't send deltas against anything older than this baseline
+        oldest = state['tick'] if baseline is None else baseline['tick']
+        self.state_history = {tick: s for (tick, s) in self.state_history.items() if tick >= oldest}
+        self.state_history[state['tick']] = state
+
+        tick_now = self.engine.current_tick
+        self.engine.load_state(state)
+        self.engine.replay_to(tick_now)
+        self.send_msg({"method": "ACKNOWLEDGE", "tick": state['tick']})
     
     def recv_input(self):
         """Checks if there is input from the server, and updates
         the local game state accordingly, including rolling back to
         a previous game state to account for past input."""
         remaining_messages = []
+        lowest_tick = self.engine.current_tick
         for message in self.incoming_messages:
             if message['method'] == "USER_INPUT":
-                lowest_tick = self.engine.current_tick
                 # register inputs from message
                 for player_input in message['inputs']:
-                    self.engine.register_input(player_input['user_id'],
-                        player_input['input_state'],
+                    changed_tick = self.engine.register_input_window(player_input['user_id'],
+                        player_input['window'],
                         tick=player_input['tick']
                     )
-                    # check if we have an old message
-                    if player_input['tick'] < lowest_tick:
-                        lowest_tick = player_input['tick']
-                # if we have old input, roll back to account for it
-                if lowest_tick < self.engine.current_tick:
-                    self.engine.rollback(lowest_tick)
+                    # check if we have an old input we didn't know about
+                    if changed_tick is not None and changed_tick < lowest_tick:
+                        lowest_tick = changed_tick
             elif message['method'] == "REMOVE_PLAYER":
                 # Remove user if server communicates so
                 self.engine.remove_user(message['user'])
@@ -660,6 +916,9 @@ class GameClient:
                 # only get the user input messages from the queue
                 remaining_messages.append(message)
         self.incoming_messages = remaining_messages
+        # if we got old input, roll back once to account for all of it
+        if lowest_tick < self.engine.current_tick:
+            self.engine.rollback(lowest_tick)
 
     def recv_join(self):
         """Checks if there is a match join update from the server, if so,
@@ -677,11 +936,14 @@ class GameClient:
                 LOGGER.debug('got START_MATCH: %s', message)
                 self.start_game(self.match_id)
                 self.engine.load_state(message['state'])
+                self.state_history = {message['state']['tick']: message['state']}
+                self.checksum_tick = -1
                 self.live_match = True
                 LOGGER.debug('sending ACK')
                 try:
                     helpers.send_packet(self.socket, helpers.marshal_message({
-                        "method": "ACKNOWLEDGE"
+                        "method": "ACKNOWLEDGE",
+                        "tick": message['state']['tick']
                     }))
                 except Exception as e:
                     LOGGER.debug('err sending ACK: %s', e)
@@ -699,6 +961,7 @@ class GameClient:
             if message['method'] == "END_MATCH":
                 victor = 'You' if (message['victor_id'] == self.player_id) else message['victor_id'][0:6]
                 self.display.add_message(f"Game over. {victor} won!")
+                self.engine.log_rollback_stats('match over')
                 finished = True
             else:
                 # only get the user input messages from the queue
@@ -708,12 +971,15 @@ class GameClient:
         return finished
     
     def send_input(self, tick):
-        """Sends the current input state to the server, scheduled for the given tick."""
+        """Sends our window of recent inputs to the server, ending with the
+        input scheduled for the given tick."""
         msg = {
             "method": "USER_INPUT",
-            "user_id": self.player_id,
-            "input_state": self.input_state,
-            "tick": tick
+            "inputs": [{
+                "user_id": self.player_id,
+                "window": bytes(self.input_window),
+                "tick": tick
+            }]
         }
         self.send_msg(msg)
 
@@ -733,6 +999,7 @@ class GameClient:
         except (TimeoutError,ConnectionError) as e:
             LOGGER.debug('Failed to connect to server: %s', e)
             return False
+        self.reader = helpers.PacketReader(self.socket)
         return True
 
     def update_server(self):
@@ -748,15 +1015,17 @@ class GameClient:
             return False
 
         [readable, writable, x] = select.select([self.socket], [self.socket], [], 0)
-        if self.socket in readable or PACKET_HEADER in helpers.INCOMING_BUFFER:
+        if self.socket in readable:
             try:
-                packet = helpers.recv_packet(self.socket)
+                if self.reader.fill() is None:
+                    LOGGER.debug('server closed the connection')
+                    return self.communication_error_handler()
+                for message in self.reader.messages():
+                    LOGGER.debug('read message from server: %s', message)
+                    self.incoming_messages.append(message)
             except Exception as e:
                     LOGGER.debug('err receiving message to server: %s', e)
                     return self.communication_error_handler()
-            LOGGER.debug('read packet from server: %s', packet)
-            if packet:
-                self.incoming_messages.append(helpers.unmarshal_message(packet))
         # write as much as we can to the socket
         tried_to_send = []
         while writable and self.outgoing_messages:
@@ -779,6 +1048,21 @@ class GameClient:
     def advance_game(self):
         """Advances the game engine by a single tick."""
         self.engine.advance_tick()
+        if self.live_match:
+            self.send_checksum()
+
+    def send_checksum(self):
+        """Reports the checksum of our game state to the server every
+        CHECKSUM_RATE ticks, once the state at that tick is final, so the
+        server can tell if we've diverged from it."""
+        final = self.engine.final_tick()
+        if final is None:
+            return
+        tick = final - final % CHECKSUM_RATE
+        if tick <= self.checksum_tick or tick not in self.engine.checksums:
+            return
+        self.checksum_tick = tick
+        self.send_msg({"method": "STATE_CHECKSUM", "tick": tick, "checksum": self.engine.checksums[tick]})
     
     def update_scoreboard(self):
         """Updates the local scoreboard, noting any changes since the last check."""
@@ -815,146 +1099,132 @@ class GameClient:
         self.socket.close()
         return False
 
-class GameServer:
-    """Manages users joining/leaving matches, determines when matches begin and end,
-    and relays inputs to and from players in a match."""
+class Lobby:
+    """Users waiting to be put in a match, in the order they asked to join
+    one."""
 
-    def __init__(self, port=SERVER_PORT):
-        self.engine = GameEngine()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(("0.0.0.0", port))
-        self.match_id = str(uuid.uuid4())
+    def __init__(self):
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, user_id):
+        return user_id in self.queue
+
+    def join(self, user_id):
+        """Queues a user up for the next match, unless they already are."""
+        if user_id not in self.queue:
+            self.queue.append(user_id)
+
+    def leave(self, user_id):
+        """Takes a user out of the queue, if they're in it."""
+        if user_id in self.queue:
+            self.queue.remove(user_id)
+
+    def ready(self):
+        """Returns whether enough users are waiting to start a match."""
+        return len(self.queue) >= MIN_PLAYERS
+
+    def take(self):
+        """Takes up to MAX_PLAYERS of the users who have waited longest out
+        of the queue, and returns them."""
+        return [self.queue.popleft() for _ in range(min(len(self.queue), MAX_PLAYERS))]
+
+    def put_back(self, user_ids):
+        """Returns users taken out of the queue to the front of it."""
+        self.queue.extendleft(reversed(user_ids))
+
+class Match:
+    """A single match: its players, its game engine, and the relaying of
+    inputs and syncing of states between them. Packets are sent through the
+    server hosting the match, so a match doesn't depend on how its players
+    are connected."""
+
+    def __init__(self, server, match_id=None):
+        self.server = server
+        self.match_id = match_id or str(uuid.uuid4())
+        self.engine = create_engine()
+        self.engine.reset_game()
+        self.players = []
         self.user_inputs = []
-        self.ready_users = []
+        # earliest tick changed by the late inputs handled since we last
+        # rolled back, if any
+        self.rollback_tick = None
         self.in_game = False
-        self.user_sockets = {}
-
-    def listen(self):
-        """Listens for users on the specified host and port."""
-        self.socket.listen()
-        addr,port = self.socket.getsockname()
-        print(f"Listening for users on {addr}:{port}...")
-    
-    def disconnect_user(self, user_id=0, user_socket=None):
-        """If the user's socket is still open, close their connection and remove their
-        socket from our dict of connections."""
-        if user_id == 0 and user_socket is not None:
-            user_id = self.get_uid_by_socket()
-        if user_id in self.user_sockets:
-            self.user_sockets[user_id].close()
-            self.user_sockets.pop(user_id)
-        if user_id in self.ready_users:
-            self.ready_users.remove(user_id)
-                
-    def get_uid_by_socket(self, user_socket):
-        """Returns the user id corresponding to the socket, if we have one. Else,
-        return None."""
-        for uid,sock in self.user_sockets.items():
-            if sock == user_socket:
-                return uid
-        return None
-    
-    def wait_for_match(self):
-        """Waits for enough users to connect and send JOIN_MATCH to begin the match. Returns
-        True if we have enough players to start the match, False if something went wrong."""
-        self.ready_users = []
-        self.engine.reset_game()
-
-        while len(self.ready_users) < MIN_PLAYERS:
-            for uid in self.user_sockets:
-                if not self.user_connected(uid):
-                    LOGGER.debug('we have %d users and %d players', len(self.user_sockets), len(self.ready_users))
-                    self.disconnect_user(uid)
-
-            # server socket + user sockets
-            all_sockets = [self.socket, *self.user_sockets.values()]
-            # Check for readable sockets
-            r_sockets, _w, _e = select.select(all_sockets, [], [], 1)
-            while r_sockets:
-                s = r_sockets.pop()
-                if s == self.socket:
-                    # If the socket is the server, then accept the connection
-                    (conn, addr) = s.accept()
-                    # and give them a user id
-                    user_id = str(uuid.uuid4())
-                    self.user_sockets[user_id] = conn
-                    LOGGER.debug('we have %d users and %d players', len(self.user_sockets), len(self.ready_users))
-                else:  # If the socket is a client
-                    # get their user ID
-                    user_id = self.get_uid_by_socket(s)
-
-                    try:
-                        packet = helpers.recv_packet(s)
-                        if packet is None:
-                            self.disconnect_user(user_id=user_id)
-                            continue
-                        request_data = helpers.unmarshal_message(packet)
-                        if request_data['method'] != "JOIN_MATCH":
-                            continue
-
-                        try: # Handle request, expect JOIN_MATCH
-                            helpers.send_packet(s, helpers.marshal_message({"method": "MATCH_JOINED", "user_id": user_id, "match_id": self.match_id}))
-                            self.ready_users.append(user_id)
-                            self.engine.add_user(user_id) # Add user to engine
-                        except Exception as e:
-                            LOGGER.debug('err responding to join_match: %s', e)
-                            
-                    except Exception as e: # If something with request goes wrong, remove from socket_dicts
-                        LOGGER.debug('we have %d users and %d players', len(self.user_sockets), len(self.ready_users))
-                        self.disconnect_user(user_id=user_id)
-        
-        return True
-
-    def start_match(self):
-        """Begin a game, initializing the local game state and telling all
-        users when the match will begin."""
+        # time the match begins at, once it has been announced
+        self.start_time = None
+        # game states sent to players, keyed by tick, kept as delta baselines
+        self.sent_states = {}
+        # tick of the latest sent state each player has acknowledged
+        self.acked_ticks = {}
+        # (tick, checksum) pairs each player has reported and we haven't checked yet
+        self.reported_checksums = {}
+        # tick of the latest state sent to each player
+        self.synced_ticks = {}
+
+    def send(self, user_id, *parts):
+        """Sends a packet, or the buffers making one up, to a player,
+        disconnecting them if it fails."""
+        try:
+            self.server.send_to(user_id, *parts)
+        except OSError as e:
+            LOGGER.debug('err sending to user %s: %s', user_id, e)
+            self.server.disconnect_user(user_id)
+
+    def add_player(self, user_id):
+        """Adds a user who sent JOIN_MATCH to the match, and tells them their
+        user ID and the match ID."""
+        self.players.append(user_id)
+        self.engine.add_user(user_id)
+        self.send(user_id, helpers.marshal_message({"method": "MATCH_JOINED", "user_id": user_id, "match_id": self.match_id}))
+
+    def remove_player(self, user_id):
+        """Removes a player who left the match, and their player entity."""
+        if user_id in self.players:
+            self.players.remove(user_id)
+            self.engine.remove_user(user_id)
+
+    def announce(self):
+        """Initializes the game state and tells every player when the match
+        will begin, at start_time. Returns False if the match can't begin."""
         # check if our player sockets are still valid
-        invalid = False
-        for user_id in self.ready_users:
-            if self.user_sockets[user_id].fileno() < 0:
-                self.user_sockets.pop(user_id)
-                invalid = True
-        if invalid:
-            return False
-
-        if len(self.ready_users) < MIN_PLAYERS:
+        for user_id in list(self.players):
+            if not self.server.user_connected(user_id):
+                self.server.disconnect_user(user_id)
+        if len(self.players) < MIN_PLAYERS:
             return False
 
         # set the starting positions, reset tick counter
         self.engine.place_players()
-        self.engine.inputs = {}
+        self.engine.inputs.clear()
+        self.engine.frames.clear()
         self.engine.current_tick = 0
         self.engine.register_state()
 
-        # LOGGER.debug("starting match: users %s", self.user_sockets)
-        # save the current state to send to users
+        # save the current state to send to players
         start_state = self.engine.serialize_current_state()
+        self.sent_states = {start_state['tick']: start_state}
+        self.acked_ticks = {}
+        self.reported_checksums = {}
+        self.synced_ticks = {}
 
         message = helpers.marshal_message({
             "method": "START_MATCH",
             "start_in": MATCH_START_DELAY,
             "state": start_state,
         })
-        # notify users of match start
-        to_start = time.time()+MATCH_START_DELAY
-        for user_id in dict(self.user_sockets): # copy dict before we iterate through it
-            try:
-                helpers.send_packet(self.user_sockets[user_id], message)
-            except Exception as e:
-                LOGGER.debug('err sending START_MATCH: %s', e)
-                if user_id in self.user_sockets:
-                    self.user_sockets.pop(user_id)
-        while time.time() < to_start:
-            pass
+        # notify players of match start
+        self.start_time = time.time()+MATCH_START_DELAY
+        for user_id in list(self.players):
+            self.send(user_id, message)
 
         # generate pickup positions
         self.engine.generate_pickup_locations(self.match_id)
-
-        self.in_game = True
         return True
 
-    def end_match(self):
-        """End a game, telling all users who the victor is."""
+    def end(self):
+        """Ends the match, telling every player who the victor is."""
         scores = self.engine.get_scores()
         victor_id = 0
         highest = -1
@@ -962,98 +1232,357 @@ class GameServer:
             if scores[uid] > highest:
                 highest = scores[uid]
                 victor_id = uid
+        self.engine.log_rollback_stats(f'match {self.match_id}')
 
         packet = helpers.marshal_message({"method":"END_MATCH","victor_id": victor_id})
-        while self.ready_users:
-            sockets = [self.user_sockets[uid] for uid in self.ready_users]
-            _r, writable, _x = select.select([], sockets, [])
-            for sock in writable:
-                uid = self.get_uid_by_socket(sock)
-                try:
-                    helpers.send_packet(sock, packet)
-                except Exception as e:
-                    LOGGER.debug('err with communicating end_match() : %s', e)
-                    self.disconnect_user(user_id=uid)
-                self.ready_users.remove(uid)
+        for uid in list(self.players):
+            self.send(uid, packet)
         self.in_game = False
 
-    def check_inputs(self):
-        """Checks each player in the match for input."""
-        [readable, w, x] = select.select(self.user_sockets.values(), [], [], 0)
-        while readable:
-            user = readable.pop()
-            try:
-                packet = helpers.recv_packet(user)
-                if packet is None:
-                    del(self.user_sockets[user])
-                    continue
-                message = helpers.unmarshal_message(packet)
-                if message['method'] != "USER_INPUT":
-                    continue
-                LOGGER.debug('msg: %s', message)
-                self.engine.register_input(message['user_id'], message['input_state'], tick=message['tick'])
-                if message['tick'] < self.engine.current_tick:
-                    self.engine.rollback(message['tick'])
-                self.user_inputs.append({
-                    "user_id": message['user_id'],
-                    "input_state": message['input_state'],
-                    "tick": message['tick']
-                })
-            except OSError as e:
-                LOGGER.debug('err relaying input: %s', e)
-                self.remove_user(user)
-            except ConnectionError as e:
-                LOGGER.debug('err relaying input: %s', e)
-                self.remove_user(user)
+    def handle_message(self, uid, message):
+        """Handles a message from a player in the match: acknowledgements of
+        game states, checksums of their game state, and their inputs, which
+        are queued up to be relayed."""
+        if message['method'] == "ACKNOWLEDGE":
+            self.acknowledge_state(uid, message['tick'])
+            return
+        if message['method'] == "STATE_CHECKSUM":
+            self.reported_checksums.setdefault(uid, []).append((message['tick'], message['checksum']))
+            return
+        if message['method'] != "USER_INPUT":
+            return
+        LOGGER.debug('msg: %s', message)
+        for player_input in message['inputs']:
+            # users can only send inputs for their own player
+            changed_tick = self.engine.register_input_window(uid, player_input['window'], tick=player_input['tick'])
+            if changed_tick is not None and changed_tick < self.engine.current_tick:
+                if self.rollback_tick is None or changed_tick < self.rollback_tick:
+                    self.rollback_tick = changed_tick
+            self.user_inputs.append({
+                "user_id": uid,
+                "window": player_input['window'],
+                "tick": player_input['tick']
+            })
+
+    def apply_late_inputs(self):
+        """Rolls back once for every late input handled since the last time,
+        to the earliest tick they changed."""
+        if self.rollback_tick is not None:
+            tick, self.rollback_tick = self.rollback_tick, None
+            self.engine.rollback(tick)
 
     def relay_inputs(self):
-        """Relays the given input to all other players
-        in the match."""
+        """Applies the inputs received since the last relay, then relays each
+        player the inputs of everyone else. The input records are packed
+        once, grouped by player, so what each player is sent is the packed
+        records on either side of their own, sliced without copying."""
+        self.apply_late_inputs()
         if self.user_inputs:
-            packet = helpers.marshal_message({
-                "method": "USER_INPUT",
-                "inputs": list(self.user_inputs)
-            })
-            # TODO: only send inputs to users that didn't do them
-            ids = [m['user_id'] for m in self.user_inputs]
-            # LOGGER.debug('input packet: %s', packet)
-            for user_id in self.user_sockets:
-                try:
-                    helpers.send_packet(self.user_sockets[user_id], packet)
-                except OSError as e:
-                    LOGGER.debug('err relaying input: %s', e)
-                    self.remove_user(user_id=user_id)
+            records = {}
+            for m in self.user_inputs:
+                records.setdefault(m['user_id'], []).append(helpers.pack_input_record(m))
+            # (start, end, count) of each player's records in the payload
+            spans = {}
+            payload = bytearray()
+            for uid, packed in records.items():
+                start = len(payload)
+                payload += b''.join(packed)
+                spans[uid] = (start, len(payload), len(packed))
+            payload = memoryview(bytes(payload))
+            count = len(self.user_inputs)
+            # players sent as many records and bytes get the same header
+            headers = {}
+            for user_id in list(self.players):
+                start, end, own = spans.get(user_id, (0, 0, 0))
+                if own == count:
+                    continue
+                size = (count - own, len(payload) - (end - start))
+                if size not in headers:
+                    headers[size] = helpers.input_frame_header(*size)
+                self.send(user_id, headers[size], payload[:start], payload[end:])
 
             self.user_inputs = []
 
-    def sync_clients(self):
-        packet = helpers.marshal_message({
-            "method": "GAME_STATE",
-            "state": self.engine.serialize_current_state()
-        })
-        for user_id in dict(self.user_sockets):
+    def verify_clients(self):
+        """Compares the state checksums players have reported with our own,
+        once our state at those ticks is final, and re-synchronizes players
+        whose state has diverged from ours."""
+        final = self.engine.final_tick()
+        if final is None:
+            return
+        diverged = []
+        for user_id, reports in self.reported_checksums.items():
+            pending = []
+            for tick, checksum in reports:
+                if tick > final:
+                    pending.append((tick, checksum))
+                # reports from before the last resync, or too old to check, are skipped
+                elif tick >= self.synced_ticks.get(user_id, 0) and tick in self.engine.checksums \
+                   and self.engine.checksums[tick] != checksum and user_id not in diverged:
+                    LOGGER.debug('user %s diverged at tick %d (now at tick %d)', user_id, tick, self.engine.current_tick)
+                    diverged.append(user_id)
+            self.reported_checksums[user_id] = pending
+        if diverged:
+            self.sync_clients(diverged)
+
+    def sync_clients(self, user_ids=None):
+        """Sends each of the given players, or every player, the difference
+        between the current game state and the last state they acknowledged
+        receiving."""
+        state = self.engine.serialize_current_state()
+        self.sent_states[state['tick']] = state
+        # players that acknowledged the same state get the same packet
+        packets = {}
+        for user_id in list(self.players if user_ids is None else user_ids):
+            if user_id not in self.players:
+                continue
+            self.synced_ticks[user_id] = state['tick']
+            baseline_tick = self.acked_ticks.get(user_id)
+            if baseline_tick not in packets:
+                packets[baseline_tick] = helpers.marshal_message({
+                    "method": "GAME_STATE",
+                    "delta": helpers.diff_states(self.sent_states.get(baseline_tick), state)
+                })
+            self.send(user_id, packets[baseline_tick])
+        self.prune_sent_states()
+
+    def acknowledge_state(self, user_id, tick):
+        """Records that a player has received the state sent at the given
+        tick, so later syncs can be sent as deltas against it."""
+        if tick in self.sent_states and tick >= self.acked_ticks.get(user_id, tick):
+            self.acked_ticks[user_id] = tick
+
+    def prune_sent_states(self):
+        """Forgets sent states that no player can still be using as a
+        baseline, keeping at most SNAPSHOT_HISTORY of them."""
+        acked = [tick for (uid, tick) in self.acked_ticks.items() if uid in self.players]
+        oldest = min(acked, default=self.engine.current_tick)
+        ticks = sorted(tick for tick in self.sent_states if tick >= oldest)[-SNAPSHOT_HISTORY:]
+        self.sent_states = {tick: self.sent_states[tick] for tick in ticks}
+
+    def finished(self):
+        """Determines whether the match is over or not."""
+        # check whether we're over the match length time in ticks
+        if self.engine.current_tick > MATCH_LENGTH*FRAMERATE:
+            LOGGER.debug('match %s reached match end, ending match', self.match_id)
+            return True
+        return False
+
+    def advance(self):
+        """Advances the game engine by one tick, after applying any late
+        inputs."""
+        self.apply_late_inputs()
+        self.engine.advance_tick()
+
+class GameServer:
+    """Manages users' connections, queues users who want to play in a lobby
+    until there are enough of them for a match, and routes each player's
+    messages to their match. Users can connect and join at any time, and any
+    number of matches can be running at once."""
+
+    def __init__(self, port=SERVER_PORT):
+        # servers whose users connect through something else have no port
+        self.socket = None
+        if port is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind(("0.0.0.0", port))
+        self.user_sockets = {}
+        # receive and send buffers for each user's connection, keyed by user ID
+        self.user_readers = {}
+        self.user_writers = {}
+        # the listening socket and users' sockets, which never block
+        self.selector = selectors.DefaultSelector()
+        # users who sent JOIN_MATCH and are waiting for a match
+        self.lobby = Lobby()
+        # matches that have been announced and haven't ended, keyed by match ID
+        self.matches = {}
+        # the match each user has joined, keyed by user ID
+        self.user_matches = {}
+
+    def listen(self):
+        """Listens for users on the specified host and port."""
+        self.socket.listen()
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        addr,port = self.socket.getsockname()
+        print(f"Listening for users on {addr}:{port}...")
+    
+    def disconnect_user(self, user_id=0, user_socket=None):
+        """If the user's socket is still open, close their connection and remove their
+        socket from our dict of connections, and take them out of their match."""
+        if user_id == 0 and user_socket is not None:
+            user_id = self.get_uid_by_socket(user_socket)
+        if user_id in self.user_sockets:
+            if self.user_writers.pop(user_id, None) is not None:
+                self.selector.unregister(self.user_sockets[user_id])
+            self.user_sockets[user_id].close()
+            self.user_sockets.pop(user_id)
+            self.user_readers.pop(user_id, None)
+        self.lobby.leave(user_id)
+        match = self.user_matches.pop(user_id, None)
+        if match is not None:
+            match.remove_player(user_id)
+                
+    def get_uid_by_socket(self, user_socket):
+        """Returns the user id corresponding to the socket, if we have one. Else,
+        return None."""
+        for uid,sock in self.user_sockets.items():
+            if sock == user_socket:
+                return uid
+        return None
+    
+    def join_match(self, user_id):
+        """Queues a user who sent JOIN_MATCH up for the next match, unless
+        they're already in one."""
+        if user_id not in self.user_matches:
+            self.lobby.join(user_id)
+
+    def send_to(self, user_id, *parts):
+        """Sends a packet, or the buffers making one up, to a user, queueing
+        whatever their socket won't take right away to be sent once it's
+        writable. Users who leave too much waiting are disconnected."""
+        writer = self.user_writers[user_id]
+        if not writer.push(*parts):
+            LOGGER.debug('user %s has %d bytes waiting to be sent, disconnecting', user_id, writer.size)
+            self.disconnect_user(user_id)
+        elif writer.size:
+            self.watch_writable(user_id, True)
+
+    def watch_writable(self, user_id, writable):
+        """Sets whether we're waiting for a user's socket to be writable, on
+        top of readable."""
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writable else 0)
+        sock = self.user_sockets[user_id]
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, user_id)
+
+    def start_matches(self):
+        """Announces a match whenever enough users are waiting in the lobby,
+        and begins the announced matches whose countdown has finished."""
+        while self.lobby.ready():
+            if self.announce_match() is None:
+                LOGGER.debug('failed to start match.')
+                break
+        for match in self.matches.values():
+            if not match.in_game and time.time() >= match.start_time:
+                match.in_game = True
+
+    def announce_match(self):
+        """Puts the users who have waited longest in the lobby in a new match
+        and tells them when it will begin. Returns the match, or None if it
+        can't begin, in which case its players are put back in the lobby."""
+        for user_id in list(self.lobby.queue):
+            if not self.user_connected(user_id):
+                self.disconnect_user(user_id)
+        if not self.lobby.ready():
+            return None
+        match = Match(self)
+        for user_id in self.lobby.take():
+            self.user_matches[user_id] = match
+            match.add_player(user_id)
+        if not match.announce():
+            for user_id in match.players:
+                self.user_matches.pop(user_id, None)
+            self.lobby.put_back(match.players)
+            return None
+        LOGGER.debug('announced match %s with %d players, %d users waiting',
+            match.match_id, len(match.players), len(self.lobby))
+        self.matches[match.match_id] = match
+        return match
+
+    def end_match(self, match):
+        """End a match, telling its players who the victor is."""
+        match.end()
+        self.matches.pop(match.match_id, None)
+        for uid in match.players:
+            self.user_matches.pop(uid, None)
+
+    def check_inputs(self, timeout=0):
+        """Accepts new users, sends users what's waiting for them once they
+        can take it, and checks each user for messages: JOIN_MATCH queues
+        them up for a match, and anything else is handled in their match.
+        Waits up to timeout seconds for something to happen."""
+        for key, events in self.selector.select(timeout):
+            if key.fileobj == self.socket:
+                self.accept_user()
+                continue
+            uid = key.data
+            if uid not in self.user_sockets: # disconnected while handling another socket
+                continue
+            user = key.fileobj
             try:
-                helpers.send_packet(self.user_sockets[user_id], packet)
+                if events & selectors.EVENT_WRITE and self.user_writers[uid].flush():
+                    self.watch_writable(uid, False)
+                if not events & selectors.EVENT_READ:
+                    continue
+                reader = self.user_readers[uid]
+                if reader.fill() is None:
+                    self.remove_user(user)
+                    continue
+                for message in reader.messages():
+                    if message['method'] == "JOIN_MATCH":
+                        self.join_match(uid)
+                    else:
+                        self.route_message(uid, message)
+            except (BlockingIOError, InterruptedError):
+                # woken up with nothing to read after all
+                continue
             except OSError as e:
                 LOGGER.debug('err relaying input: %s', e)
-                self.remove_user(user_id=user_id)
+                self.remove_user(user)
+            except helpers.ProtocolError as e:
+                LOGGER.debug('err decoding input: %s', e)
+                self.remove_user(user)
 
-    def match_finished(self):
-        """Determines whether the current match is over or not."""
-        # check whether we're over the match length time in ticks
-        if self.engine.current_tick > MATCH_LENGTH*FRAMERATE:
-            LOGGER.debug('reached match end, ending match')
-            return True
+    def accept_user(self):
+        """Accepts a connection and gives the user an ID."""
+        try:
+            (conn, addr) = self.socket.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        user_id = str(uuid.uuid4())
+        self.user_sockets[user_id] = conn
+        self.user_readers[user_id] = helpers.PacketReader(conn)
+        self.user_writers[user_id] = helpers.PacketWriter(conn)
+        self.selector.register(conn, selectors.EVENT_READ, user_id)
+        LOGGER.debug('we have %d users, %d waiting', len(self.user_sockets), len(self.lobby))
+
+    def route_message(self, uid, message):
+        """Handles a message from a user in the match they're playing in, if
+        it has been announced. Returns that match, or None."""
+        match = self.user_matches.get(uid)
+        if match is None or match.match_id not in self.matches:
+            return None
+        match.handle_message(uid, message)
+        return match
+
+    def relay_inputs(self):
+        """Relays the inputs received in each match to its players."""
+        for match in list(self.matches.values()):
+            match.relay_inputs()
+
+    def verify_clients(self):
+        """Re-synchronizes players whose state has diverged from their
+        match's."""
+        for match in list(self.matches.values()):
+            if match.in_game:
+                match.verify_clients()
 
     def advance_game(self):
-        """Advance the game engine by one tick."""
-        self.engine.advance_tick()
+        """Advance every running match by one tick."""
+        for match in list(self.matches.values()):
+            if match.in_game:
+                match.advance()
+
+    def finished_matches(self):
+        """Returns the running matches that are over."""
+        return [match for match in self.matches.values() if match.in_game and match.finished()]
 
     def remove_user(self, user):
         """Remove user when disconnect happens."""
         uid = self.get_uid_by_socket(user)
         LOGGER.debug('removing user %s: %s', uid, user)
-        self.engine.remove_user(uid)
         self.disconnect_user(uid)
         
         # Idea is to relay to all users that a user has disconnected. Having some issues with id's and which ones to send
@@ -1074,4 +1603,3 @@ class GameServer:
         """Returns whether the user represented by the given user ID has
         a socket that is not closed or in a failure state."""
         return (user_id in self.user_sockets) and (not self.user_sockets[user_id].fileno() < 0)
-
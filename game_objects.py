@@ -1,10 +1,29 @@
 """Class definitions for entities/objects used in the game."""
 
+import hashlib
+import struct
+import zlib
+from collections import deque
 from enum import Enum, auto
-import pygame
 
+from fixedpoint import div, mul, ratio, to_units, whole
 from globalvars import *
 
+# Fields of an entity that go into state checksums: entity ID, kind, position,
+# velocity, direction, knockback and score. Entities without a direction,
+# knockback or score use (0, 0), -1 and 0.
+CHECKSUM_RECORD = struct.Struct('!qbddddddqq')
+
+# Two 32-bit coordinates hashed from a match's seed and a pickup's index.
+PICKUP_HASH = struct.Struct('!II')
+
+# Bounds of the arena, in units.
+ARENA_UNITS = to_units(ARENA_SIZE)
+# Diagonal movement is slowed down by this much, in units.
+SQRT_2 = to_units(2**0.5)
+# Knockback velocity decays by this much every tick, in units.
+KNOCKBACK_DECAY = to_units(1) - ratio(1, 1000)
+
 
 class EntityKind(Enum):
     PLAYER = auto()
@@ -12,19 +31,40 @@ class EntityKind(Enum):
     PICKUP = auto()
 
 class GameEntity:
-    """Base class for game entities."""
+    """Base class for game entities. Positions and velocities are in the
+    units of fixedpoint.py, while size and speed are given in pixels and
+    kept in units."""
 
-    def __init__(self, kind, size, position=(0,0), velocity=(0,0), speed=0):
+    __slots__ = ('eid', 'position', 'velocity', 'speed', 'kind', 'size')
+
+    def __init__(self, kind, size, position=(0,0), velocity=(0,0), speed=0, eid=None):
+        # identifier assigned by the GameEngine, stable across rollbacks
+        # and the same on every node
+        self.eid = eid
         self.position = position
         self.velocity = velocity
-        self.speed = speed
+        self.speed = to_units(speed)
         self.kind = kind
-        self.size = size
+        self.size = to_units(size)
     
     def serialize(self):
         """Returns a dict representing the properties of the
         Entity. Intended to be inherited."""
-        return {"position": [*self.position], "velocity": [*self.velocity]}
+        return {"eid": self.eid, "position": [*self.position], "velocity": [*self.velocity]}
+
+    def snapshot(self):
+        """Returns a tuple of the fields that change over the course of a
+        game, which restore can write back. Intended to be inherited."""
+        return (self.position, self.velocity)
+
+    def restore(self, fields):
+        """Overwrites the fields saved by snapshot. Intended to be inherited."""
+        self.position, self.velocity = fields
+
+    def checksum(self):
+        """Returns a CRC of the entity's ID, kind and the fields that change
+        over the course of a game. Intended to be inherited."""
+        return zlib.crc32(CHECKSUM_RECORD.pack(self.eid, self.kind.value, *self.position, *self.velocity, 0, 0, -1, 0))
 
     def update_position(self):
         """Updates position based on current velocity."""
@@ -40,44 +80,46 @@ class GameEntity:
         x,y = self.position
         if x-self.size < 0:
             x = self.size
-        elif x+self.size > ARENA_SIZE:
-            x = ARENA_SIZE-self.size
+        elif x+self.size > ARENA_UNITS:
+            x = ARENA_UNITS-self.size
         if y-self.size < 0:
             y = self.size
-        elif y+self.size > ARENA_SIZE:
-            y = ARENA_SIZE-self.size
+        elif y+self.size > ARENA_UNITS:
+            y = ARENA_UNITS-self.size
         return (x,y)
     
     def get_normal_velocity(self):
         """Returns current velocity as a double, scaled so
         its magnitude is 1."""
         x,y = self.velocity
-        return (x/self.speed, y/self.speed)
+        return (div(x, self.speed), div(y, self.speed))
     
     def rescale_velocity(self, scalar):
-        """Rescales the current velocity by a scalar value."""
+        """Rescales the current velocity by a scalar value in units."""
         x,y = self.get_normal_velocity()
-        return (scalar*x,scalar*y)
+        return (mul(scalar, x), mul(scalar, y))
     
     def out_of_bounds(self):
         """Returns True if the Entity is entirely out of the
         bounds of the arena, False otherwise."""
         x,y = self.position
-        if x+self.size < 0 or x-self.size > ARENA_SIZE:
+        if x+self.size < 0 or x-self.size > ARENA_UNITS:
             return True
-        if y+self.size < 0 or y-self.size > ARENA_SIZE:
+        if y+self.size < 0 or y-self.size > ARENA_UNITS:
             return True
         
 
 class Player(GameEntity):
     """Class for player entities."""
 
-    def __init__(self, uid=0, position=(0,0), velocity=(0,0), knockback=-1):
-        super().__init__(EntityKind.PLAYER, PLAYER_SIZE, position=position, velocity=velocity, speed=PLAYER_SPEED)
+    __slots__ = ('uid', 'direction', 'knockback_time', 'knockback_speed', 'score', 'knockback')
+
+    def __init__(self, uid=0, position=(0,0), velocity=(0,0), knockback=-1, eid=None):
+        super().__init__(EntityKind.PLAYER, PLAYER_SIZE, position=position, velocity=velocity, speed=PLAYER_SPEED, eid=eid)
         self.uid = uid
         self.direction = self.get_normal_velocity()
         self.knockback_time = KNOCKBACK_TIME
-        self.knockback_speed = KNOCKBACK_SPEED
+        self.knockback_speed = to_units(KNOCKBACK_SPEED)
         self.score = 0
         # whether the player is in a 'knockback' state or not after
         # getting hit. knockback < 0 indicates normal movement, while
@@ -89,19 +131,32 @@ class Player(GameEntity):
         data['kind'] = "player"
         data['knockback'] = self.knockback
         data['uid'] = self.uid
+        data['score'] = self.score
+        data['direction'] = [*self.direction]
         return data
 
+    def snapshot(self):
+        return (self.position, self.velocity, self.direction, self.knockback, self.score)
+
+    def restore(self, fields):
+        self.position, self.velocity, self.direction, self.knockback, self.score = fields
+
+    def checksum(self):
+        return zlib.crc32(CHECKSUM_RECORD.pack(self.eid, self.kind.value, *self.position, *self.velocity,
+            *self.direction, self.knockback, self.score))
+
     def take_hit(self, projectile):
         """Apply effects of getting hit by a projectile."""
         self.knockback = self.knockback_time
         self.velocity = projectile.rescale_velocity(self.knockback_speed)
     
     def update_velocity(self, input_state=None):
-        """Update player velocity according to input."""
+        """Update player velocity according to input, packed as INPUT_*
+        bits."""
 
         # player can't move while in knockback state
         if self.knockback > 0:
-            self.velocity = self.rescale_velocity(1 - 1/1000)
+            self.velocity = self.rescale_velocity(KNOCKBACK_DECAY)
             self.knockback -= 1
             return
         elif self.knockback == 0:
@@ -113,30 +168,37 @@ class Player(GameEntity):
             vel_x = 0
             vel_y = 0
 
-            if input_state[pygame.K_w]: # up
+            if input_state & INPUT_UP:
                 vel_y -= self.speed
-            if input_state[pygame.K_s]: # down
+            if input_state & INPUT_DOWN:
                 vel_y += self.speed
-            if input_state[pygame.K_a]: # left
+            if input_state & INPUT_LEFT:
                 vel_x -= self.speed
-            if input_state[pygame.K_d]: # right
+            if input_state & INPUT_RIGHT:
                 vel_x += self.speed
             
             if vel_x != 0 and vel_y != 0:
-                # multiply by sqrt(2) to adjust for diagonal
-                vel_x = int(vel_x/(2**0.5))
-                vel_y = int(vel_y/(2**0.5))
+                # divide by sqrt(2) to adjust for diagonal
+                vel_x = whole(div(vel_x, SQRT_2))
+                vel_y = whole(div(vel_y, SQRT_2))
             
             self.velocity = (vel_x, vel_y)
             if vel_x != 0 or vel_y != 0:
                 self.direction = self.get_normal_velocity()
 
-    def shoot_projectile(self):
-        """Spawns a pickup with velocity corresponding to the Player's."""
+    def projectile_velocity(self):
+        """Returns the velocity of a projectile shot by the Player, or None
+        if it isn't facing any direction."""
         dir_x, dir_y = self.direction
         if dir_x == 0 and dir_y == 0:
             return None
-        proj_vel = (dir_x*PROJECTILE_SPEED, dir_y*PROJECTILE_SPEED)
+        return (dir_x*PROJECTILE_SPEED, dir_y*PROJECTILE_SPEED)
+
+    def shoot_projectile(self):
+        """Spawns a projectile with velocity corresponding to the Player's."""
+        proj_vel = self.projectile_velocity()
+        if proj_vel is None:
+            return None
         return Projectile(self.uid, self.position, proj_vel)
     
     def collect_pickup(self, pickup):
@@ -150,8 +212,17 @@ class Player(GameEntity):
 class Projectile(GameEntity):
     """Class for projectile entities."""
 
-    def __init__(self, owner_uid, position, velocity):
-        super().__init__(EntityKind.PROJECTILE, PROJECTILE_SIZE, position=position, velocity=velocity, speed=PROJECTILE_SPEED)
+    __slots__ = ('owner_uid',)
+
+    def __init__(self, owner_uid, position, velocity, eid=None):
+        super().__init__(EntityKind.PROJECTILE, PROJECTILE_SIZE, position=position, velocity=velocity, speed=PROJECTILE_SPEED, eid=eid)
+        self.owner_uid = owner_uid
+
+    def reset(self, owner_uid, position, velocity, eid=None):
+        """Reinitializes a projectile taken from an EntityPool."""
+        self.eid = eid
+        self.position = position
+        self.velocity = velocity
         self.owner_uid = owner_uid
     
     def serialize(self):
@@ -163,34 +234,103 @@ class Projectile(GameEntity):
 class Pickup(GameEntity):
     """Class for item pickup entities."""
 
-    def __init__(self, position=(0, 0)):
-        super().__init__(EntityKind.PICKUP, PROJECTILE_SIZE, position=position, velocity=(0,0), speed=0)
+    __slots__ = ('value',)
+
+    def __init__(self, position=(0, 0), eid=None):
+        super().__init__(EntityKind.PICKUP, PROJECTILE_SIZE, position=position, velocity=(0,0), speed=0, eid=eid)
         self.value = POINTS_PER_PICKUP
 
+    def reset(self, position=(0, 0), eid=None):
+        """Reinitializes a pickup taken from an EntityPool."""
+        self.eid = eid
+        self.position = position
+        self.velocity = (0,0)
+
     def serialize(self):
         data = super().serialize()
         data['kind'] = 'pickup'
         return data
 
+class PickupPositions:
+    """Endless stream of the positions pickups spawn at in a match, indexed by
+    how many pickups came before. Each position is hashed from the seed and
+    its index, so any of them can be computed when it's needed, in any order,
+    and streams with different seeds don't share any state."""
+
+    def __init__(self, seed):
+        self.key = hashlib.blake2b(str(seed).encode(), digest_size=16).digest()
+
+    def __getitem__(self, index):
+        digest = hashlib.blake2b(index.to_bytes(8, 'big'), digest_size=PICKUP_HASH.size, key=self.key).digest()
+        x_bits, y_bits = PICKUP_HASH.unpack(digest)
+        span = ARENA_SIZE - 2*PICKUP_SIZE
+        return (to_units(PICKUP_SIZE + x_bits % span), to_units(PICKUP_SIZE + y_bits % span))
+
+class EntityPool:
+    """Keeps removed entities of one class to be reused for new ones, so
+    spawning them doesn't allocate. An entity removed at some tick can still
+    be restored from the snapshots of the ticks before it, so it's only
+    reused once no rollback can reach those snapshots: MAX_ROLLBACK_TICKS
+    later, plus STATE_SAVE_RATE since a rollback restores the last state
+    saved at or before the tick it goes back to."""
+
+    def __init__(self, cls, horizon=MAX_ROLLBACK_TICKS+STATE_SAVE_RATE):
+        self.cls = cls
+        self.horizon = horizon
+        # (tick, entity) pairs, oldest first
+        self.released = deque()
+
+    def clear(self):
+        """Forgets every removed entity."""
+        self.released.clear()
+
+    def release(self, entity, tick):
+        """Hands back an entity removed from the game at the given tick."""
+        self.released.append((tick, entity))
+
+    def create(self, tick, *args):
+        """Returns an entity for the given tick built from args, reusing the
+        oldest removed entity if no snapshot can refer to it any more."""
+        if self.released and self.released[0][0] < tick - self.horizon:
+            _tick, entity = self.released.popleft()
+            entity.reset(*args)
+            return entity
+        return self.cls(*args)
+
+    def forget_since(self, tick):
+        """Forgets entities removed at or after the given tick, after rolling
+        back to it, since they're back in the game."""
+        while self.released and self.released[-1][0] >= tick:
+            self.released.pop()
+
 def deserialize_entity(entity_data):
     """Returns an Entity based on its serialized data."""
     pos_x,pos_y = entity_data['position']
     vel_x,vel_y = entity_data['velocity']
+    eid = entity_data['eid']
     if entity_data['kind'] == "player":
         uid = entity_data['uid']
         knockback = entity_data['knockback']
-        return Player(uid,
+        player = Player(uid,
             position=(pos_x,pos_y),
             velocity=(vel_x,vel_y), 
-            knockback=knockback
+            knockback=knockback,
+            eid=eid
         )
+        player.score = entity_data['score']
+        # the direction a stationary player faces can't be told from its velocity
+        dir_x,dir_y = entity_data['direction']
+        player.direction = (dir_x,dir_y)
+        return player
     elif entity_data['kind'] == "projectile":
         owner_uid = entity_data['owner_uid']
         return Projectile(owner_uid, 
             position=(pos_x,pos_y),
-            velocity=(vel_x,vel_y)
+            velocity=(vel_x,vel_y),
+            eid=eid
         )
     elif entity_data['kind'] == 'pickup':
         return Pickup(
-            position=(pos_x,pos_y)
+            position=(pos_x,pos_y),
+            eid=eid
         )
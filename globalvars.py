@@ -14,8 +14,25 @@ if DEBUG_ENABLED:
     LOGGER.setLevel(logging.DEBUG)
 
 PACKET_READ_SIZE = 4096 # bytes
-PACKET_HEADER    = b'\x57\x67' # packet header
-PACKET_TERM      = b'\xF1\x54'  # packet terminator
+# Version of the wire protocol, carried in every frame header.
+PROTOCOL_VERSION = 1
+# Frame header: protocol version, message type, payload length.
+FRAME_HEADER_FORMAT = '!BBI'
+# Largest frame payload accepted off the wire. A header claiming more is
+# treated as a protocol error rather than buffered.
+MAX_FRAME_SIZE = 1024*1024 # bytes
+# Message type codes carried in the frame header.
+MESSAGE_TYPES = {
+    "JOIN_MATCH": 1,
+    "MATCH_JOINED": 2,
+    "START_MATCH": 3,
+    "ACKNOWLEDGE": 4,
+    "USER_INPUT": 5,
+    "GAME_STATE": 6,
+    "END_MATCH": 7,
+    "REMOVE_PLAYER": 8,
+    "STATE_CHECKSUM": 9,
+}
 
 FRAMERATE = 60 # frames per second
 
@@ -39,12 +56,47 @@ SERVER_PORT = 5555
 
 # How many ticks in advance inputs are scheduled for.
 GLOBAL_INPUT_DELAY = 5
+# Bits of the packed input byte recorded for each player every tick.
+INPUT_UP    = 0x01
+INPUT_LEFT  = 0x02
+INPUT_DOWN  = 0x04
+INPUT_RIGHT = 0x08
+INPUT_FIRE  = 0x10
+# How many ticks of past input each input packet repeats, so that a late
+# packet rarely forces a rollback.
+INPUT_WINDOW = 8 # ticks
 # How often the engine should record the current state for rollback.
-STATE_SAVE_RATE = 100 # ticks apart
-# How often to send re-synchronization packets to each client.
-RESYNC_RATE = 300 # ticks apart
+STATE_SAVE_RATE = 1 # ticks apart
+# How far back the engine can roll back to account for late input. Saved
+# states and inputs older than this are dropped.
+MAX_ROLLBACK_TICKS = 2*FRAMERATE # ticks
+# How far ahead of the current tick input can be scheduled. Input scheduled
+# further ahead is dropped.
+MAX_INPUT_LEAD = FRAMERATE # ticks
+# How often clients report a checksum of their game state to the server. The
+# server only re-synchronizes clients whose checksum doesn't match its own,
+# sending a delta against the last state each client acknowledged.
+CHECKSUM_RATE = 30 # ticks apart
+# How many sent game states the server keeps around as delta baselines.
+SNAPSHOT_HISTORY = 32
+# Most bytes the server keeps waiting to be sent to a user once their
+# connection stops keeping up, before disconnecting them as too slow.
+SEND_QUEUE_LIMIT = 64*1024 # bytes
+# Most ticks the server and clients run back to back to catch up after
+# falling behind. Any more that were missed are dropped.
+MAX_CATCH_UP_TICKS = 10 # ticks
 # How much lag to simulate on the client-side.
 EXTRA_CLIENT_LATENCY = 0 # ticks
+# Which GameEngine implementation to simulate the game with: "python", or
+# "numpy" to store entities in arrays and move them in batches (requires
+# NumPy). Both produce the same game states.
+ENGINE_BACKEND = "python"
+# Set to true to keep entity positions and velocities in integer fixed-point
+# units instead of floats, so every node simulates bit-identical states
+# whatever machine it runs on. Must be the same on the server and clients.
+FIXED_POINT = True
+# How many fractional bits fixed-point units have, so a pixel is 2**bits units.
+FIXED_POINT_BITS = 16
 
 
 ARENA_SIZE  = 1000 # pixels
@@ -67,8 +119,6 @@ PICKUP_SIZE = 15
 POINTS_PER_PICKUP = 15
 # How many ticks between pickup spawns.
 PICKUP_SPAWN_RATE = 30
-# How many positions to pre-generate.
-PICKUP_POSITIONS_GENERATED = 4096
 MAX_PICKUPS = 5
 GUIDELINE_LENGTH = 40
 GUIDELINE_WIDTH  = 5
@@ -1,93 +1,327 @@
 """Helper functions for formatting messages, etc."""
 
+import asyncio
 import json
-import pickle
-import socket
+import struct
+import uuid
+from collections import deque
 
-from globalvars import LOGGER, PACKET_TERM,PACKET_HEADER,PACKET_READ_SIZE
+from globalvars import LOGGER, FRAME_HEADER_FORMAT, MAX_FRAME_SIZE, MESSAGE_TYPES, PACKET_READ_SIZE, PROTOCOL_VERSION, SEND_QUEUE_LIMIT
 
-INCOMING_BUFFER = b""
+# Every frame starts with this header, followed by a payload of the given length.
+FRAME_HEADER = struct.Struct(FRAME_HEADER_FORMAT)
+# Reverse lookup of MESSAGE_TYPES, from type code to method name.
+MESSAGE_METHODS = {code: method for (method, code) in MESSAGE_TYPES.items()}
+GAME_STATE_TYPE = MESSAGE_TYPES["GAME_STATE"]
+USER_INPUT_TYPE = MESSAGE_TYPES["USER_INPUT"]
+# USER_INPUT payloads are a record count, then for each record the user ID,
+# the last tick of the input window and its length, followed by one packed
+# input byte per tick of the window (oldest first).
+INPUT_COUNT = struct.Struct('!H')
+INPUT_RECORD = struct.Struct('!16sIB')
+# Most buffers PacketWriter hands to a single sendmsg call.
+GATHER_LIMIT = 64
+
+class ProtocolError(ValueError):
+    """Raised when a frame read off the wire can't be decoded."""
 
 def marshal_message(message):
     """Accepts a serializable dict to convert to the message format used for
     communicating between client and server. Returns a bytestring suitable to
-    send over TCP."""
-    return PACKET_HEADER+pickle.dumps(json.dumps(message).encode())+PACKET_TERM
+    send over TCP.
 
-def unmarshal_message(packet):
-    """Accepts a bytestring packet from a socket and converts to a message dict."""
-    # LOGGER.debug('unstripped: %s',packet)
-    message = packet[packet.find(PACKET_HEADER)+len(PACKET_HEADER):packet.rfind(PACKET_TERM)]
-    # LOGGER.debug('stripped: %s',message)
-    message = json.loads(pickle.loads(message))
-    # unmarshal input state
+    The method is carried as a type code in the frame header, and the rest of
+    the message is JSON-encoded as the payload, except for USER_INPUT messages
+    which are packed as binary."""
     if message['method'] == "USER_INPUT":
-        if "inputs" in message:
-            inputs = []
-            for i in message['inputs']:
-                unmarshaled_state = {
-                    "user_id": i['user_id'],
-                    "tick": i['tick'],
-                    "input_state": {}
-                }
-                state = i['input_state']
-                for key in state:
-                    if key == "fired":
-                        unmarshaled_state["input_state"][key] = state[key]
-                    else:
-                        unmarshaled_state["input_state"][int(key)] = state[key]
-                inputs.append(unmarshaled_state)
-            message['inputs'] = inputs
-            return message
-        elif "input_state" in message:
-            unmarshaled_msg = {
-                "method": "USER_INPUT",
-                "user_id": message['user_id'],
-                "tick": message['tick'],
-                "input_state": {}
-            }
-            for key in message['input_state']:
-                if key == "fired":
-                    unmarshaled_msg["input_state"][key] = message['input_state'][key]
-                else:
-                    unmarshaled_msg["input_state"][int(key)] = message['input_state'][key]
-            return unmarshaled_msg
+        payload = pack_inputs(message['inputs'])
     else:
-        return message
-
-def recv_data(s):
-    """Receives data from the socket, adding it to the buffer."""
-    global INCOMING_BUFFER
-    data = s.recv(PACKET_READ_SIZE)
-    if not data:
-        s.close()
+        body = {key: value for (key, value) in message.items() if key != 'method'}
+        payload = json.dumps(body, separators=(',', ':')).encode()
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, MESSAGE_TYPES[message['method']], len(payload)) + payload
+
+def frame_length(buffer, offset=0):
+    """Returns the total length of the frame starting at the given offset of
+    the buffer, or None if not enough of the header has arrived yet. Raises
+    ProtocolError if the header claims more than MAX_FRAME_SIZE bytes."""
+    if len(buffer) - offset < FRAME_HEADER.size:
         return None
-    # LOGGER.debug('data received: %s', data)
-    INCOMING_BUFFER += data
-
-def recv_packet(user_socket):
-    """Reads a data packet from the socket, and returns the raw bytes. If
-    the socket has closed (returned no data on recv), return None."""
-    global INCOMING_BUFFER
-    packet = b''
-    packet_read = False
-    while not packet_read:
-        if PACKET_HEADER not in INCOMING_BUFFER:
-            # keep reading until we find the header
-            recv_data(user_socket)
-            continue
-        header_index = INCOMING_BUFFER.find(PACKET_HEADER)
+    version, _kind, length = FRAME_HEADER.unpack_from(buffer, offset)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'unsupported protocol version {version}')
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f'frame of {length} bytes is too large')
+    return FRAME_HEADER.size + length
+
+def decode_frame(buffer, offset=0):
+    """Decodes the frame starting at the given offset of a receive buffer,
+    which may be any bytes-like object (including a memoryview). Returns a
+    tuple of the message dict and the length of the frame, or (None, 0) if
+    the whole frame hasn't arrived yet."""
+    length = frame_length(buffer, offset)
+    if length is None or len(buffer) - offset < length:
+        return (None, 0)
+    _version, kind, _length = FRAME_HEADER.unpack_from(buffer, offset)
+    if kind not in MESSAGE_METHODS:
+        raise ProtocolError(f'unknown message type {kind}')
+    if MESSAGE_METHODS[kind] == "USER_INPUT":
+        message = {"inputs": unpack_inputs(buffer, offset+FRAME_HEADER.size, offset+length)}
+    else:
+        try:
+            message = json.loads(str(buffer[offset+FRAME_HEADER.size:offset+length], 'utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ProtocolError(f'malformed payload: {e}')
+        if not isinstance(message, dict):
+            raise ProtocolError('malformed payload: not an object')
+    message['method'] = MESSAGE_METHODS[kind]
+    return (message, length)
 
-        if PACKET_TERM not in INCOMING_BUFFER[header_index:]:
-            # keep reading until we find the terminator
-            recv_data(user_socket)
+def unmarshal_message(packet):
+    """Accepts a bytestring packet from a socket and converts to a message dict."""
+    message, length = decode_frame(packet)
+    if message is None:
+        raise ProtocolError('incomplete frame')
+    return message
+
+def pack_inputs(inputs):
+    """Packs a list of input records, dicts with a user_id, a tick and a
+    window of packed input bytes ending at that tick, into a USER_INPUT
+    payload."""
+    return INPUT_COUNT.pack(len(inputs)) + b''.join(pack_input_record(record) for record in inputs)
+
+def pack_input_record(record):
+    """Packs a single input record the way it appears in a USER_INPUT
+    payload."""
+    window = bytes(record['window'])
+    return INPUT_RECORD.pack(uuid.UUID(record['user_id']).bytes, record['tick'], len(window)) + window
+
+def input_frame_header(count, length):
+    """Returns the start of a USER_INPUT frame holding count input records
+    packed with pack_input_record, length bytes in all: the frame header and
+    the record count. Sending it followed by the records sends the same
+    frame marshal_message would, without joining them."""
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, USER_INPUT_TYPE, INPUT_COUNT.size + length) + INPUT_COUNT.pack(count)
+
+def unpack_inputs(buffer, offset, end):
+    """Unpacks the input records of a USER_INPUT payload lying between the
+    given offsets of the buffer."""
+    try:
+        (count,) = INPUT_COUNT.unpack_from(buffer, offset)
+        offset += INPUT_COUNT.size
+        inputs = []
+        for _ in range(count):
+            user_id, tick, length = INPUT_RECORD.unpack_from(buffer, offset)
+            offset += INPUT_RECORD.size
+            inputs.append({
+                "user_id": str(uuid.UUID(bytes=user_id)),
+                "tick": tick,
+                "window": bytes(buffer[offset:offset+length])
+            })
+            offset += length
+    except struct.error as e:
+        raise ProtocolError(f'malformed input payload: {e}')
+    if offset != end:
+        raise ProtocolError('malformed input payload: wrong length')
+    return inputs
+
+def diff_states(baseline, state):
+    """Returns a delta that turns the baseline game state into the given one.
+    Only entities that were added or removed, and the fields of entities that
+    changed, are included. If the baseline is None, every entity is included
+    in full."""
+    old_entities = {} if baseline is None else {e['eid']: e for e in baseline['entities']}
+    changed = []
+    for entity in state['entities']:
+        old = old_entities.pop(entity['eid'], None)
+        if old is None or old['kind'] != entity['kind']:
+            changed.append(entity)
             continue
-        term_index = INCOMING_BUFFER.find(PACKET_TERM, header_index)
+        fields = {key: value for (key, value) in entity.items() if old.get(key) != value}
+        if fields:
+            fields['eid'] = entity['eid']
+            changed.append(fields)
+    delta = {key: value for (key, value) in state.items() if key != 'entities'}
+    delta['baseline'] = None if baseline is None else baseline['tick']
+    delta['changed'] = changed
+    delta['removed'] = list(old_entities)
+    return delta
+
+def apply_delta(baseline, delta):
+    """Returns the game state produced by applying a delta from diff_states to
+    its baseline state. Entities keep the order they had in the baseline, and
+    new entities follow in the order the delta lists them."""
+    entities = {} if baseline is None else {e['eid']: e for e in baseline['entities']}
+    for eid in delta['removed']:
+        entities.pop(eid, None)
+    for fields in delta['changed']:
+        eid = fields['eid']
+        if eid in entities and 'kind' not in fields:
+            entities[eid] = {**entities[eid], **fields}
+        else:
+            entities[eid] = fields
+    state = {key: value for (key, value) in delta.items() if key not in ('baseline', 'changed', 'removed')}
+    state['entities'] = list(entities.values())
+    return state
 
-        packet = INCOMING_BUFFER[header_index:term_index+len(PACKET_TERM)]
-        INCOMING_BUFFER = INCOMING_BUFFER[term_index:]
-        packet_read = True
-    return packet
+class PacketReader:
+    """Receive buffer for a single connection. Bytes are read with recv_into
+    straight into a growable bytearray, and whole frames are handed out as
+    memoryview slices of it, so nothing is copied per frame except the bytes
+    the JSON decoder reads."""
+
+    def __init__(self, sock, size=PACKET_READ_SIZE):
+        self.socket = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # offset of the first byte that hasn't been handed out yet
+        self.start = 0
+        # offset just past the last byte received
+        self.end = 0
+
+    def reserve(self, size):
+        """Makes room for at least size more bytes after the received data,
+        moving the unread bytes to the front of the buffer or growing it."""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= size:
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            # views handed out earlier keep the old buffer alive, so allocate
+            # a new one rather than resizing in place
+            buffer = bytearray(max(2*len(self.buffer), pending+size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def fill(self):
+        """Receives whatever the socket has ready with a single recv_into call.
+        Returns the number of bytes read, or None if the socket has closed.
+        Frames returned by next_packet before this call are invalidated."""
+        self.reserve(PACKET_READ_SIZE)
+        count = self.socket.recv_into(self.view[self.end:])
+        if not count:
+            self.socket.close()
+            return None
+        # LOGGER.debug('data received: %s', bytes(self.view[self.end:self.end+count]))
+        self.end += count
+        return count
+
+    def next_packet(self):
+        """Returns a memoryview of the next whole frame in the buffer, or None
+        if there isn't one yet. The view is only valid until the next call to
+        fill, so it should be unmarshaled right away."""
+        length = frame_length(self.view[self.start:self.end])
+        if length is None:
+            return None
+        if self.end - self.start < length:
+            # make sure the rest of a large frame will fit
+            self.reserve(length - (self.end - self.start))
+            return None
+        packet = self.view[self.start:self.start+length]
+        self.start += length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return packet
+
+    def has_packet(self):
+        """Returns True if a whole frame is already waiting in the buffer."""
+        length = frame_length(self.view[self.start:self.end])
+        return length is not None and self.end - self.start >= length
+
+    def messages(self):
+        """Yields every whole message waiting in the buffer, unmarshaled."""
+        packet = self.next_packet()
+        while packet is not None:
+            yield unmarshal_message(packet)
+            packet = self.next_packet()
+
+class PacketWriter:
+    """Send buffer for a single non-blocking connection. Packets are queued
+    whole, each as the list of buffers it's made of, and as many of them as
+    the socket takes are sent together with one sendmsg call, so a packet
+    gathered from buffers shared with other users' packets is never joined
+    into one. A slow connection never blocks the sender. Each GAME_STATE
+    packet is a complete delta against what the user last acknowledged, so
+    one replaces any queued before it that haven't started being sent. Past
+    limit bytes waiting, the connection is too slow to keep up."""
+
+    def __init__(self, sock, limit=SEND_QUEUE_LIMIT):
+        self.socket = sock
+        self.limit = limit
+        # (length, buffers) of the packets waiting to be sent, the first of
+        # which may be partly sent
+        self.packets = deque()
+        # bytes of the first packet already sent
+        self.sent = 0
+        # bytes waiting to be sent
+        self.size = 0
+
+    def push(self, *parts):
+        """Queues a packet made up of the given buffers, and sends as much as
+        the socket will take right away. Returns False if more than limit
+        bytes are left waiting."""
+        if FRAME_HEADER.unpack_from(parts[0])[1] == GAME_STATE_TYPE and self.packets:
+            # keep the partly sent packet, which can't be taken back
+            kept = [queued for (i, queued) in enumerate(self.packets)
+                    if (i == 0 and self.sent) or FRAME_HEADER.unpack_from(queued[1][0])[1] != GAME_STATE_TYPE]
+            self.size -= sum(length for (length, buffers) in self.packets) - sum(length for (length, buffers) in kept)
+            self.packets = deque(kept)
+        length = sum(len(part) for part in parts)
+        self.packets.append((length, parts))
+        self.size += length
+        self.flush()
+        return self.size <= self.limit
+
+    def flush(self):
+        """Sends queued packets until the socket would block. Returns True
+        once nothing is left waiting."""
+        while self.packets:
+            buffers = []
+            skip = self.sent
+            for (length, parts) in self.packets:
+                for part in parts:
+                    if skip >= len(part):
+                        skip -= len(part)
+                        continue
+                    buffers.append(memoryview(part)[skip:] if skip else part)
+                    skip = 0
+                if len(buffers) >= GATHER_LIMIT:
+                    break
+            try:
+                count = self.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= count
+            partial = count < sum(len(buffer) for buffer in buffers)
+            # drop the packets sent in full
+            count += self.sent
+            while self.packets and count >= self.packets[0][0]:
+                count -= self.packets.popleft()[0]
+            self.sent = count
+            if partial:
+                return False
+        return True
+
+async def read_frame(stream):
+    """Reads the next whole frame from an asyncio StreamReader and returns it
+    as bytes, or None if the connection closed."""
+    try:
+        header = await stream.readexactly(FRAME_HEADER.size)
+        payload = await stream.readexactly(frame_length(header) - FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    return header + payload
+
+async def read_message(stream):
+    """Reads the next whole frame from an asyncio StreamReader and returns it
+    unmarshaled, or None if the connection closed."""
+    frame = await read_frame(stream)
+    if frame is None:
+        return None
+    return unmarshal_message(frame)
 
 def send_packet(user_socket, packet):
     """Sends a packet to the socket."""
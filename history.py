@@ -0,0 +1,207 @@
+"""Bounded histories of past game states, used for rolling back."""
+
+from globalvars import INPUT_FIRE, MAX_INPUT_LEAD, MAX_PLAYERS, MAX_ROLLBACK_TICKS
+
+# Stands in for a missing input in an InputHistory. Packed inputs only use
+# the low INPUT_* bits, so it can never be a real input.
+NO_INPUT = 0xFF
+# Set on inputs in an InputHistory that were predicted rather than received.
+PREDICTED = 0x80
+
+
+class Snapshot:
+    """A saved game state, compact enough to take every tick. Unlike the
+    dicts from GameEngine.serialize_current_state, it holds the entities
+    themselves with the fields that change during a game, so restoring it
+    overwrites entities in place instead of building new ones."""
+
+    __slots__ = ('tick', 'generated', 'live', 'next_eid', 'entities', 'fields')
+
+    def __init__(self):
+        self.tick = None
+        self.generated = 0
+        self.live = 0
+        self.next_eid = 0
+        # the entities, in the order the engine held them, and the fields of
+        # each. Kept in separate lists rather than as pairs, since every pair
+        # would be a container the garbage collector has to keep tracking for
+        # as long as the snapshot is kept.
+        self.entities = []
+        self.fields = []
+
+
+class SnapshotRing:
+    """Fixed-capacity ring buffer of game states, keyed by tick. Each tick has
+    a single slot, so a state overwrites the one saved capacity ticks before
+    it, and memory use doesn't grow over the course of a match."""
+
+    def __init__(self, capacity=MAX_ROLLBACK_TICKS+1):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        """Forgets every saved state."""
+        self.ticks = [None] * self.capacity
+        self.states = [None] * self.capacity
+
+    def __contains__(self, tick):
+        return self.ticks[tick % self.capacity] == tick
+
+    def __getitem__(self, tick):
+        if tick not in self:
+            raise KeyError(tick)
+        return self.states[tick % self.capacity]
+
+    def __setitem__(self, tick, state):
+        index = tick % self.capacity
+        self.ticks[index] = tick
+        self.states[index] = state
+
+    def reusable(self, tick):
+        """Returns the state in the slot the given tick would be saved to,
+        whichever tick it was saved for, so its storage can be reused. Returns
+        None if the slot is empty."""
+        return self.states[tick % self.capacity]
+
+    def latest_at(self, tick):
+        """Returns the most recent state saved at or before the given tick, or
+        None if there isn't one within the last capacity ticks."""
+        for past_tick in range(tick, tick - self.capacity, -1):
+            if past_tick in self:
+                return self.states[past_tick % self.capacity]
+        return None
+
+    def oldest(self):
+        """Returns the oldest state still saved, or None if there are none."""
+        saved = [t for t in self.ticks if t is not None]
+        if not saved:
+            return None
+        return self[min(saved)]
+
+
+class InputHistory:
+    """Ring buffer of packed inputs, with a row for each tick and a column for
+    each player, holding the last capacity ticks. Players are given a column
+    the first time we get input from them.
+
+    Ticks simulated without a player's input are simulated with a prediction
+    of it, which is recorded, so that when the real input arrives we can tell
+    whether the tick needs simulating again."""
+
+    def __init__(self, capacity=MAX_ROLLBACK_TICKS+MAX_INPUT_LEAD+1, players=MAX_PLAYERS):
+        self.capacity = capacity
+        self.stride = players
+        self.clear()
+
+    def clear(self):
+        """Forgets every input and player."""
+        # column of each player, keyed by user ID
+        self.slots = {}
+        # newest tick we've had input for from each player, by column
+        self.latest = []
+        self.ticks = [None] * self.capacity
+        self.data = bytearray([NO_INPUT]) * (self.capacity * self.stride)
+
+    def slot_of(self, uid):
+        """Returns the column of the player with the given user ID, giving it
+        one if it doesn't have one yet."""
+        slot = self.slots.get(uid)
+        if slot is None:
+            slot = self.slots[uid] = len(self.slots)
+            self.latest.append(None)
+            if slot == self.stride:
+                self.widen(2*self.stride)
+        return slot
+
+    def widen(self, stride):
+        """Makes room for more players, keeping the inputs we have."""
+        data = bytearray([NO_INPUT]) * (self.capacity * stride)
+        for row in range(self.capacity):
+            data[row*stride:row*stride+self.stride] = self.data[row*self.stride:(row+1)*self.stride]
+        self.data = data
+        self.stride = stride
+
+    def record(self, uid, tick, user_input):
+        """Records the packed input of a player for a tick, replacing the
+        inputs of the tick capacity ticks before it. Returns True if this
+        changed the input we had, or False if it didn't or the tick is too old
+        to keep."""
+        slot = self.slot_of(uid)
+        start = self.row_start(tick)
+        if start is None:
+            return False
+        if self.latest[slot] is None or tick > self.latest[slot]:
+            self.latest[slot] = tick
+        index = start + slot
+        previous = self.data[index]
+        self.data[index] = user_input
+        if previous != NO_INPUT and previous & PREDICTED:
+            # the tick was simulated with the predicted input
+            return previous & ~PREDICTED != user_input
+        return previous != user_input
+
+    def row_start(self, tick):
+        """Returns the index of the first input of the tick's row, clearing
+        the row if it holds an older tick, or None if it's already been
+        reused for a newer tick."""
+        row = tick % self.capacity
+        if self.ticks[row] != tick:
+            if self.ticks[row] is not None and self.ticks[row] > tick:
+                return None
+            self.ticks[row] = tick
+            start = row * self.stride
+            self.data[start:start+self.stride] = bytes([NO_INPUT]) * self.stride
+        return row * self.stride
+
+    def get(self, tick, uid):
+        """Returns the packed input of a player for a tick, or None if we
+        haven't received it."""
+        row = tick % self.capacity
+        slot = self.slots.get(uid)
+        if slot is None or self.ticks[row] != tick:
+            return None
+        user_input = self.data[row * self.stride + slot]
+        return None if user_input & PREDICTED else user_input
+
+    def is_predicted(self, tick, uid):
+        """Returns True if the tick was simulated with a prediction of the
+        player's input."""
+        row = tick % self.capacity
+        slot = self.slots.get(uid)
+        if slot is None or self.ticks[row] != tick:
+            return False
+        user_input = self.data[row * self.stride + slot]
+        return user_input != NO_INPUT and bool(user_input & PREDICTED)
+
+    def input_for(self, tick, uid):
+        """Returns the packed input to simulate a player with at a tick. If we
+        haven't received it, their input from the tick before is repeated
+        without firing, and recorded as a prediction. Returns None if we
+        don't have that either."""
+        user_input = self.get(tick, uid)
+        if user_input is not None:
+            return user_input
+        previous = self.get_any(tick-1, uid)
+        if previous is None:
+            return None
+        user_input = previous & ~PREDICTED & ~INPUT_FIRE
+        start = self.row_start(tick)
+        if start is not None:
+            self.data[start + self.slot_of(uid)] = user_input | PREDICTED
+        return user_input
+
+    def get_any(self, tick, uid):
+        """Returns the packed input of a player for a tick, received or
+        predicted, or None if we have neither."""
+        row = tick % self.capacity
+        slot = self.slots.get(uid)
+        if slot is None or self.ticks[row] != tick:
+            return None
+        user_input = self.data[row * self.stride + slot]
+        return None if user_input == NO_INPUT else user_input
+
+    def latest_tick(self, uid):
+        """Returns the newest tick we've had input for from a player, or None
+        if we've had none."""
+        slot = self.slots.get(uid)
+        return None if slot is None else self.latest[slot]
@@ -1,21 +1,51 @@
 """Executable for hosting matches."""
 
-import time
 import game
+import async_server
+import sharded_server
 import sys
+import ticker
 from globalvars import *
 
+USAGE = "Usage: server.py [--select | --workers N] [port]"
+
 def main():
-    # accept command-line args, including where to listen
-    if len(sys.argv) == 1:
+    # accept command-line args, including where to listen, and whether to
+    # poll sockets in a loop instead of running on an asyncio event loop, or
+    # to play matches in N worker processes (0 for one per CPU)
+    args = sys.argv[1:]
+    use_select = '--select' in args
+    if use_select:
+        args.remove('--select')
+    workers = None
+    if '--workers' in args:
+        i = args.index('--workers')
+        try:
+            workers = int(args[i+1])
+        except:
+            sys.exit(USAGE)
+        del args[i:i+2]
+        if use_select or workers < 0:
+            sys.exit(USAGE)
+    if len(args) == 0:
         port = SERVER_PORT
-    elif len(sys.argv) == 2:
+    elif len(args) == 1:
         try:
-            port = int(sys.argv[1])
+            port = int(args[0])
         except:
-            sys.exit("Usage: server.py [port]")
+            sys.exit(USAGE)
     else:
-        sys.exit("Usage: server.py [port]")
+        sys.exit(USAGE)
+
+    # everything loaded so far lives as long as the server does
+    game.freeze_heap()
+
+    if workers is not None:
+        sharded_server.run(port, workers or None)
+        return
+    if not use_select:
+        async_server.run(port)
+        return
 
     # set up GameServer object
     game_server = game.GameServer(port=port)
@@ -23,43 +53,36 @@ def main():
     # listen on a port for users who want to start a match
     game_server.listen()
 
+    ticks = ticker.TickScheduler()
     while True:
-        # wait for enough users to start a match
-        LOGGER.debug('waiting for match...')
-        if not game_server.wait_for_match():
-            continue
-
-        # when enough users connect, try to start a match
-        LOGGER.debug('starting match...')
-        if not game_server.start_match():
-            LOGGER.debug('failed to start match.')
-            continue
-    
-        # while the match is not over:
-        last_tick = time.time()
-        while game_server.in_game:
-            #print(game_server.engine.current_tick)
-            # get inputs from each user
-            game_server.check_inputs()
-            # relay inputs to each other user
-            game_server.relay_inputs()
-
-
-            # check if we need to move to the next frame
-            t = time.time()
-            if t-last_tick > 1/FRAMERATE: # seconds per frame
-                last_tick = t
-                game_server.advance_game()
-                # send a synchronization packet to all clients if it's time
-                if game_server.engine.current_tick > 0 and \
-                   game_server.engine.current_tick % RESYNC_RATE == 0:
-                    LOGGER.debug('syncing clients...')
-                    game_server.sync_clients()
+        # accept users and get their messages, both from users waiting for
+        # a match and from players in one, and send what's waiting for
+        # users whose connection can take it. Nothing else needs doing
+        # before the next tick is due, or with no match going on, until a
+        # user sends something.
+        if game_server.matches:
+            timeout = ticks.timeout()
+        else:
+            timeout = 1
+        game_server.check_inputs(timeout=timeout)
+        if not game_server.matches:
+            # no ticks were missed while there was nothing to tick
+            ticks.restart()
+        # start a match as soon as enough users are waiting for one
+        game_server.start_matches()
+        # relay inputs to each other user
+        game_server.relay_inputs()
 
-            # check if the match is over
-            if game_server.match_finished(): 
-                game_server.end_match()
+        # run every tick that's due, catching up if we fell behind
+        for _ in range(ticks.due()):
+            game_server.advance_game()
+            # resync any clients whose state has diverged from ours
+            game_server.verify_clients()
 
+        # check if any match is over
+        for match in game_server.finished_matches():
+            game_server.end_match(match)
+            ticks.log_stats('server ticks')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""Server split across processes: a front end that accepts connections and
+groups users into matches, and worker processes that each play some of the
+matches, so hosting capacity grows with the number of cores rather than
+being capped by one interpreter."""
+
+import asyncio
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import uuid
+
+import async_server
+import game
+import helpers
+from globalvars import *
+
+# Messages between the front end and a worker are sent in batches, each a
+# pickled list of tuples prefixed with its length.
+BATCH_HEADER = struct.Struct('!I')
+JOIN_MATCH = MESSAGE_TYPES["JOIN_MATCH"]
+
+class Channel:
+    """One end of the stream between the front end and a worker. Tuples
+    posted in the same pass of the event loop are written as one batch."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.items = []
+
+    def post(self, item):
+        """Queues a tuple to be written once this pass of the loop is done."""
+        if not self.items:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.items.append(item)
+
+    def flush(self):
+        """Writes every queued tuple as one batch. Packets sent to several
+        users are only pickled once."""
+        data = pickle.dumps(self.items, pickle.HIGHEST_PROTOCOL)
+        self.items = []
+        self.writer.write(BATCH_HEADER.pack(len(data)) + data)
+
+async def read_batch(reader):
+    """Reads the next batch of tuples from a Channel, or None if the other
+    end closed."""
+    try:
+        header = await reader.readexactly(BATCH_HEADER.size)
+        data = await reader.readexactly(BATCH_HEADER.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+    return pickle.loads(data)
+
+class MatchWorker(async_server.AsyncGameServer):
+    """AsyncGameServer run in a worker process, whose users are connected
+    through the front end. It's told which users to start a match with, is
+    sent the frames its players send, and sends packets back through the
+    front end.
+
+    Front end to worker: ("start", user_ids), ("leave", user_id) and
+    ("message", user_id, frame). Worker to front end: ("send", user_id,
+    packet), ("ended", user_ids) once a match is over, and ("failed",
+    user_ids) if a match couldn't start."""
+
+    def __init__(self, sock):
+        super().__init__(port=None)
+        self.front_end = sock
+
+    async def serve(self):
+        """Handles what the front end sends until it goes away."""
+        reader, writer = await asyncio.open_connection(sock=self.front_end)
+        self.channel = Channel(writer)
+        while (batch := await read_batch(reader)) is not None:
+            for item in batch:
+                self.handle(item)
+
+    def handle(self, item):
+        """Handles one tuple from the front end."""
+        if item[0] == "message":
+            _kind, user_id, frame = item
+            try:
+                self.dispatch(user_id, helpers.unmarshal_message(frame))
+            except helpers.ProtocolError as e:
+                LOGGER.debug('err decoding message from user %s: %s', user_id, e)
+        elif item[0] == "start":
+            for user_id in item[1]:
+                self.join_match(user_id)
+            if not self.begin_match():
+                LOGGER.debug('failed to start match.')
+                # the front end queues them up again itself
+                for user_id in item[1]:
+                    self.lobby.leave(user_id)
+                self.channel.post(("failed", item[1]))
+        elif item[0] == "leave":
+            self.disconnect_user(item[1])
+
+    def end_match(self, match):
+        super().end_match(match)
+        self.channel.post(("ended", match.players))
+
+    def send_to(self, user_id, *parts):
+        """Queues a packet, or the buffers making one up, to be sent to a
+        user through the front end. It's copied to the front end either way,
+        so its buffers are joined here."""
+        self.channel.post(("send", user_id, b''.join(parts)))
+
+    def user_connected(self, user_id):
+        # the front end tells us when a user disconnects
+        return user_id in self.user_matches or user_id in self.lobby
+
+def run_worker(sock, inherited):
+    """Entry point of a worker process. Closes the sockets it inherited that
+    belong to the front end or other workers, so it notices when the front
+    end exits, and freezes the heap it starts with."""
+    for other in inherited:
+        other.close()
+    game.freeze_heap()
+    try:
+        asyncio.run(MatchWorker(sock).serve())
+    except KeyboardInterrupt:
+        pass
+
+class ShardedGameServer:
+    """Front end that accepts every connection and queues users who send
+    JOIN_MATCH in a lobby. Each time enough are waiting, their match is
+    handed to the worker process playing the fewest matches, and the front
+    end then only forwards frames between its players and that worker."""
+
+    def __init__(self, port=SERVER_PORT, workers=None):
+        # start the workers before binding, so they don't inherit the socket
+        pairs = [socket.socketpair() for _ in range(workers or os.cpu_count())]
+        self.worker_sockets = [front for (front, back) in pairs]
+        self.workers = []
+        for i, (front, back) in enumerate(pairs):
+            inherited = [s for pair in pairs for s in pair if s is not back]
+            process = multiprocessing.Process(target=run_worker, args=(back, inherited),
+                                              name=f'match-worker-{i}', daemon=True)
+            process.start()
+            back.close()
+            self.workers.append(process)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("0.0.0.0", port))
+        self.user_writers = {}
+        # index of the worker playing each user's match, keyed by user ID
+        self.user_workers = {}
+        # number of matches each worker is playing
+        self.loads = [0] * len(self.workers)
+        # users who sent JOIN_MATCH and are waiting for a match
+        self.lobby = game.Lobby()
+        self.channels = []
+        self.tasks = set()
+
+    async def serve(self):
+        """Accepts connections until interrupted."""
+        for i, sock in enumerate(self.worker_sockets):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.channels.append(Channel(writer))
+            task = asyncio.create_task(self.read_worker(i, reader))
+            self.tasks.add(task)
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        addr,port = self.socket.getsockname()
+        print(f"Listening for users on {addr}:{port} with {len(self.workers)} match workers...")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """Reads frames from a user until they disconnect, handling JOIN_MATCH
+        and forwarding the rest to their match's worker undecoded."""
+        user_id = str(uuid.uuid4())
+        self.user_writers[user_id] = writer
+        LOGGER.debug('we have %d users', len(self.user_writers))
+        try:
+            while (frame := await helpers.read_frame(reader)) is not None:
+                if helpers.FRAME_HEADER.unpack_from(frame)[1] == JOIN_MATCH:
+                    self.join_match(user_id)
+                elif user_id in self.user_workers:
+                    self.channels[self.user_workers[user_id]].post(("message", user_id, frame))
+        except (OSError, helpers.ProtocolError) as e:
+            LOGGER.debug('err reading from user %s: %s', user_id, e)
+        self.disconnect_user(user_id)
+
+    def join_match(self, user_id):
+        """Queues a user up for the next match, unless they're already in
+        one, and hands a match to a worker once enough users are waiting."""
+        if user_id in self.user_workers:
+            return
+        self.lobby.join(user_id)
+        self.hand_out_match()
+
+    def hand_out_match(self):
+        """Hands a match to the worker playing the fewest, if enough users
+        are waiting for one."""
+        if self.lobby.ready():
+            worker = min(range(len(self.workers)), key=self.loads.__getitem__)
+            players = self.lobby.take()
+            LOGGER.debug('starting match on worker %d, %d users waiting', worker, len(self.lobby))
+            for player in players:
+                self.user_workers[player] = worker
+            self.channels[worker].post(("start", players))
+            self.loads[worker] += 1
+
+    def disconnect_user(self, user_id):
+        """Closes a user's connection, and tells their match's worker."""
+        writer = self.user_writers.pop(user_id, None)
+        if writer is not None:
+            writer.close()
+        self.lobby.leave(user_id)
+        worker = self.user_workers.pop(user_id, None)
+        if worker is not None:
+            self.channels[worker].post(("leave", user_id))
+
+    async def read_worker(self, worker, reader):
+        """Sends users the packets a worker sends them, until it exits."""
+        while (batch := await read_batch(reader)) is not None:
+            for item in batch:
+                if item[0] == "send":
+                    _kind, user_id, packet = item
+                    writer = self.user_writers.get(user_id)
+                    if writer is not None and not writer.is_closing():
+                        writer.write(packet)
+                        if writer.transport.get_write_buffer_size() > SEND_QUEUE_LIMIT:
+                            LOGGER.debug('user %s is too slow, disconnecting', user_id)
+                            self.disconnect_user(user_id)
+                elif item[0] == "ended":
+                    self.loads[worker] -= 1
+                    for user_id in item[1]:
+                        self.user_workers.pop(user_id, None)
+                elif item[0] == "failed":
+                    # put the players still connected back at the front of
+                    # the lobby, and try again
+                    self.loads[worker] -= 1
+                    waiting = []
+                    for user_id in item[1]:
+                        if self.user_workers.get(user_id) == worker:
+                            del self.user_workers[user_id]
+                            waiting.append(user_id)
+                    self.lobby.put_back(waiting)
+                    self.hand_out_match()
+        LOGGER.debug('worker %d exited', worker)
+        # nobody can play on it any more
+        self.loads[worker] = float('inf')
+        for user_id, index in list(self.user_workers.items()):
+            if index == worker:
+                self.disconnect_user(user_id)
+
+def run(port=SERVER_PORT, workers=None):
+    """Runs a ShardedGameServer with the given number of workers, one per
+    CPU by default, on the given port until interrupted."""
+    asyncio.run(ShardedGameServer(port=port, workers=workers).serve())
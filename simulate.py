@@ -0,0 +1,126 @@
+"""Executable for simulating matches headlessly, without sockets or a display,
+across a pool of processes. Each match is played from a seed, by scripted
+players or from recorded inputs, and its scores and speed are reported."""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+# the engine doesn't draw anything, so don't announce pygame in every worker
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import game
+from globalvars import (ENGINE_BACKEND, FRAMERATE, INPUT_DOWN, INPUT_FIRE, INPUT_LEFT, INPUT_RIGHT,
+    INPUT_UP, LOGGER, MATCH_LENGTH, MAX_PLAYERS, MIN_PLAYERS)
+
+# Directions scripted players move in, as packed inputs.
+DIRECTIONS = (0, INPUT_UP, INPUT_UP|INPUT_RIGHT, INPUT_RIGHT, INPUT_DOWN|INPUT_RIGHT,
+              INPUT_DOWN, INPUT_DOWN|INPUT_LEFT, INPUT_LEFT, INPUT_UP|INPUT_LEFT)
+# Chance each tick that a scripted player changes direction, and that it fires.
+TURN_CHANCE = 0.05
+FIRE_CHANCE = 0.1
+# Ticks in a match. Servers end a match once it's past MATCH_LENGTH seconds.
+MATCH_TICKS = MATCH_LENGTH*FRAMERATE + 1
+
+def scripted_inputs(seed, player, ticks):
+    """Returns the packed inputs of a scripted player for every tick of a
+    match: it wanders around, holding each direction for a while, and fires
+    every so often. The same seed and player always give the same inputs."""
+    rng = random.Random(f'{seed}:{player}')
+    direction = rng.choice(DIRECTIONS)
+    inputs = []
+    for _ in range(ticks):
+        if rng.random() < TURN_CHANCE:
+            direction = rng.choice(DIRECTIONS)
+        inputs.append(direction | (INPUT_FIRE if rng.random() < FIRE_CHANCE else 0))
+    return inputs
+
+def simulate_match(seed, inputs, backend=ENGINE_BACKEND):
+    """Plays a match from the seed with the given packed inputs, a list of
+    one input per tick for each player, and returns its results."""
+    start = time.perf_counter()
+    engine = game.create_engine(backend)
+    engine.reset_game()
+    uids = [f'player{i}' for i in range(len(inputs))]
+    for uid in uids:
+        engine.add_user(uid)
+    engine.place_players()
+    engine.generate_pickup_locations(seed)
+    ticks = min(len(player_inputs) for player_inputs in inputs)
+    for tick in range(ticks):
+        for uid, player_inputs in zip(uids, inputs):
+            engine.register_input(uid, player_inputs[tick], tick)
+        engine.advance_tick()
+    elapsed = time.perf_counter() - start
+    scores = engine.get_scores()
+    return {
+        "seed": seed,
+        "scores": [scores[uid] for uid in uids],
+        # like Match.end, the first player with the highest score wins
+        "victor": max(range(len(uids)), key=lambda i: scores[uids[i]]),
+        "ticks": ticks,
+        "checksum": engine.checksum(),
+        "ticks_per_second": ticks / elapsed,
+    }
+
+def run_job(job):
+    """Runs a match in a worker process, given (seed, inputs, backend,
+    record). If inputs is a number, that many players are scripted. The
+    inputs are sent back with the results if record is set."""
+    seed, inputs, backend, record = job
+    if isinstance(inputs, int):
+        inputs = [scripted_inputs(seed, player, MATCH_TICKS) for player in range(inputs)]
+    result = simulate_match(seed, inputs, backend)
+    if record:
+        result["inputs"] = inputs
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--matches', type=int, default=100, help="how many matches to play")
+    parser.add_argument('-p', '--players', type=int, default=MIN_PLAYERS, help="scripted players in each match")
+    parser.add_argument('-s', '--seed', type=int, default=0, help="seed of the first match, the rest count up from it")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('-b', '--backend', default=ENGINE_BACKEND, help="engine backend, python or numpy")
+    parser.add_argument('--record', metavar='PATH', help="save the seed and inputs of every match to a file")
+    parser.add_argument('--replay', metavar='PATH', help="play the matches saved to a file with --record")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only print the summary")
+    args = parser.parse_args()
+    if not MIN_PLAYERS <= args.players <= MAX_PLAYERS:
+        sys.exit(f"simulate.py: players must be between {MIN_PLAYERS} and {MAX_PLAYERS}")
+    LOGGER.setLevel('INFO')
+
+    if args.replay:
+        with open(args.replay) as f:
+            jobs = [(match["seed"], match["inputs"], args.backend, bool(args.record)) for match in json.load(f)]
+    else:
+        jobs = [(args.seed + i, args.players, args.backend, bool(args.record)) for i in range(args.matches)]
+
+    start = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(args.processes) as pool:
+        for result in pool.imap_unordered(run_job, jobs, chunksize=max(1, len(jobs) // 64)):
+            results.append(result)
+            if not args.quiet:
+                print(f"seed {result['seed']:>6}  scores {' '.join(f'{s:>4}' for s in result['scores'])}"
+                      f"  victor {result['victor']}  checksum {result['checksum']:>10}"
+                      f"  {result['ticks_per_second']:>8,.0f} ticks/s")
+    elapsed = time.perf_counter() - start
+
+    results.sort(key=lambda result: result["seed"])
+    if args.record:
+        with open(args.record, 'w') as f:
+            json.dump([{"seed": r["seed"], "inputs": r["inputs"]} for r in results], f)
+    ticks = sum(result["ticks"] for result in results)
+    wins = [0] * max((len(result["scores"]) for result in results), default=0)
+    for result in results:
+        wins[result["victor"]] += 1
+    print(f"{len(results)} matches in {elapsed:.1f}s: {len(results)/elapsed*60:,.0f} matches/min, "
+          f"{ticks/elapsed:,.0f} ticks/s, wins by player {wins}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Spatial partitioning used to find collisions between entities."""
+
+from fixedpoint import to_units
+from globalvars import ARENA_SIZE, PICKUP_SIZE, PLAYER_SIZE, PROJECTILE_SIZE
+
+# Two entities can only collide if they're closer than the sum of their
+# sizes, so with cells this big each entity only needs to be checked against
+# entities in its own cell and the eight around it.
+GRID_CELL_SIZE = to_units(2*max(PLAYER_SIZE, PROJECTILE_SIZE, PICKUP_SIZE))
+
+# Offsets of the neighbouring cells checked from each cell. Only half of the
+# neighbours are listed so that every pair of cells is visited once.
+NEIGHBOUR_OFFSETS = ((1, 0), (-1, 1), (0, 1), (1, 1))
+
+
+class CollisionGrid:
+    """Uniform grid over the arena used as a broadphase for collision checks.
+    Entities outside of the arena are clamped into the border cells, which
+    still keeps any two entities that could touch in neighbouring cells.
+    Sizes are in the same units as entity positions."""
+
+    def __init__(self, cell_size=GRID_CELL_SIZE, arena_size=to_units(ARENA_SIZE)):
+        self.cell_size = cell_size
+        self.columns = -(-arena_size // cell_size)
+
+    def cell_of(self, position):
+        """Returns the (column, row) of the cell containing the position."""
+        x,y = position
+        last = self.columns - 1
+        column = min(max(int(x // self.cell_size), 0), last)
+        row = min(max(int(y // self.cell_size), 0), last)
+        return (column, row)
+
+    def find_collisions(self, entities):
+        """Finds every pair of colliding entities in the given list of entities.
+
+        Returns a dict, where keys are the entity ID of each Entity and the values
+        are a list of other entities the Entity has collided with, in the same
+        order as the list of entities."""
+        ids = [entity.eid for entity in entities]
+        ordered = list(entities)
+        cells = {}
+        for index, entity in enumerate(ordered):
+            cells.setdefault(self.cell_of(entity.position), []).append(index)
+
+        hits = {}
+        for (column, row), members in cells.items():
+            # pairs within the cell, then pairs with the neighbouring cells
+            self.check_pairs(ordered, members, members, hits, same_cell=True)
+            for d_column, d_row in NEIGHBOUR_OFFSETS:
+                others = cells.get((column+d_column, row+d_row))
+                if others:
+                    self.check_pairs(ordered, members, others, hits)
+
+        all_collisions = {}
+        for index, collided in hits.items():
+            collided.sort()
+            all_collisions[ids[index]] = [ordered[other] for other in collided]
+        return all_collisions
+
+    def check_pairs(self, ordered, members, others, hits, same_cell=False):
+        """Records a collision for every overlapping pair of an entity from
+        members and one from others, both given as indices into ordered. If
+        both are the same cell, each pair is only checked once."""
+        for i, a in enumerate(members):
+            first = ordered[a]
+            ax,ay = first.position
+            size = first.size
+            for b in (others[i+1:] if same_cell else others):
+                second = ordered[b]
+                bx,by = second.position
+                dx = ax - bx
+                dy = ay - by
+                reach = size + second.size
+                if dx*dx + dy*dy < reach*reach:
+                    hits.setdefault(a, []).append(b)
+                    hits.setdefault(b, []).append(a)
@@ -0,0 +1,94 @@
+"""Scheduling of fixed-length game ticks against a monotonic clock."""
+
+import time
+
+from globalvars import FRAMERATE, LOGGER, MAX_CATCH_UP_TICKS
+
+
+class TickScheduler:
+    """Tells a loop how many ticks of 1/rate seconds are due. The time that
+    passes between calls is added to an accumulator, and a tick is due for
+    every whole tick length it holds, so waking up late doesn't push later
+    ticks back: the loop runs the ticks it missed back to back, and keeps
+    pace with real time and with everyone else ticking at the same rate.
+    After a stall, at most max_catch_up ticks are run at once and the rest
+    are dropped, rather than the loop doing nothing but tick for a while.
+
+    Also records how late each tick was run compared to when it was due,
+    its jitter."""
+
+    def __init__(self, rate=FRAMERATE, max_catch_up=MAX_CATCH_UP_TICKS, clock=time.monotonic):
+        self.interval = 1/rate
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        # ticks run, and how late they were in all and at most, in seconds
+        self.ticks = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        # ticks run back to back with the one before, to catch up
+        self.caught_up = 0
+        # ticks dropped after stalls
+        self.dropped = 0
+        self.restart()
+
+    def restart(self):
+        """Starts counting time from now, with no ticks due, e.g. after time
+        during which nothing needed ticking."""
+        self.last_time = self.clock()
+        # time passed that no tick has been run for yet
+        self.accumulator = 0.0
+
+    def elapse(self):
+        """Adds the time passed since the last call to the accumulator."""
+        now = self.clock()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+    def timeout(self):
+        """Returns how many seconds are left until the next tick is due, or
+        0 if one already is."""
+        self.elapse()
+        return max(0.0, self.interval - self.accumulator)
+
+    def due(self):
+        """Returns how many ticks are due, which the caller should then run,
+        and records how late each of them is."""
+        self.elapse()
+        count = int(self.accumulator / self.interval)
+        if count > self.max_catch_up:
+            LOGGER.debug('%d ticks behind, dropping %d', count, count - self.max_catch_up)
+            self.dropped += count - self.max_catch_up
+            self.accumulator -= (count - self.max_catch_up) * self.interval
+            count = self.max_catch_up
+        for i in range(count):
+            # each tick was due the length of the ticks after it ago
+            jitter = self.accumulator - (i+1) * self.interval
+            self.total_jitter += jitter
+            self.max_jitter = max(self.max_jitter, jitter)
+        self.ticks += count
+        self.caught_up += max(0, count - 1)
+        self.accumulator -= count * self.interval
+        return count
+
+    def wait(self):
+        """Sleeps until a tick is due, then returns how many are."""
+        time.sleep(self.timeout())
+        return self.due()
+
+    def stats(self):
+        """Summarizes the ticks run so far: how many, how late they were on
+        average and at most, in milliseconds, how many were run back to back
+        to catch up, and how many were dropped."""
+        return {
+            "ticks": self.ticks,
+            "mean_jitter_ms": self.total_jitter / max(1, self.ticks) * 1000,
+            "max_jitter_ms": self.max_jitter * 1000,
+            "caught_up": self.caught_up,
+            "dropped": self.dropped,
+        }
+
+    def log_stats(self, label):
+        """Logs stats()."""
+        stats = self.stats()
+        LOGGER.debug('%s: %d ticks, jitter: mean %.2fms, max %.2fms, caught up: %d, dropped: %d', label,
+            stats['ticks'], stats['mean_jitter_ms'], stats['max_jitter_ms'], stats['caught_up'], stats['dropped'])